@@ -24,10 +24,10 @@ for path in possible_paths:
         break
 
 try:
-    from utility_e3sm_netcdf import get_regional_bounds
+    from utility_e3sm_netcdf import get_file_catalog_path, get_files_from_catalog, get_regional_bounds
     REGION_VALIDATION_AVAILABLE = True
 except ImportError:
-    print("⚠ Could not import utility_e3sm_netcdf - region validation disabled")
+    print("⚠ Could not import utility_e3sm_netcdf - region validation and file counts disabled")
     REGION_VALIDATION_AVAILABLE = False
 
 def validate_region_names(regions):
@@ -59,7 +59,7 @@ def validate_region_names(regions):
     
     return issues
 
-def dry_run_test(json_file):
+def dry_run_test(json_file, update_catalog=False):
     """Test the extraction function setup without processing files."""
     
     print(f"Dry-run testing: {json_file}")
@@ -130,14 +130,31 @@ def dry_run_test(json_file):
         
         # Test file path access
         sim_path = Path(entry.get('simulation_path', ''))
-        if sim_path.exists():
+        sim_path_accessible = sim_path.exists()
+        if sim_path_accessible:
             print(f"✓ Simulation path accessible")
         else:
             print(f"⚠ Cannot access simulation path: {sim_path}")
         
-        # Show what would be processed
+        # Show what would be processed, counting the matching files from the file catalog instead of walking the directory. A dry run does not
+        # write anything, so the catalog is only queried (it is built or updated by the extraction scripts, or here with --update-catalog).
+        start_year = entry.get('start_year', 2015)
+        end_year = entry.get('end_year', 2100)
+        catalog_directory = entry.get('catalog_directory', None)
+        catalog_exists = False
+        if REGION_VALIDATION_AVAILABLE and sim_path_accessible:
+            if update_catalog:
+                get_files_from_catalog(str(sim_path), catalog_directory=catalog_directory)
+            catalog_exists = os.path.isfile(get_file_catalog_path(str(sim_path), catalog_directory=catalog_directory))
         for idx in range(len(variables)):
-            print(f"  Group {idx+1}: {len(variables[idx])} variables, substring {netcdf_substrings[idx]}")
+            file_count = ""
+            if catalog_exists:
+                files = get_files_from_catalog(str(sim_path), file_name_substrings=netcdf_substrings[idx], file_extension='.nc', 
+                                               start_year=start_year, end_year=end_year, catalog_directory=catalog_directory, update_catalog=False)
+                file_count = f", {len(files)} files for {start_year}-{end_year}"
+            elif REGION_VALIDATION_AVAILABLE and sim_path_accessible:
+                file_count = ", catalog not built"
+            print(f"  Group {idx+1}: {len(variables[idx])} variables, substring {netcdf_substrings[idx]}{file_count}")
     
     print("\n" + "=" * 60)
     if all_valid:
@@ -147,11 +164,13 @@ def dry_run_test(json_file):
     return all_valid
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python dry_run_test.py <json_file>")
+    # With --update-catalog, the file catalog of each simulation directory is built or updated before the files are counted.
+    arguments = [argument for argument in sys.argv[1:] if argument != '--update-catalog']
+    if len(arguments) != 1:
+        print("Usage: python dry_run_test.py [--update-catalog] <json_file>")
         print("Example: python dry_run_test.py e3sm_extract_time_series_h0_regs.json")
         sys.exit(1)
     
-    json_file = sys.argv[1]
-    success = dry_run_test(json_file)
+    json_file = arguments[0]
+    success = dry_run_test(json_file, update_catalog='--update-catalog' in sys.argv[1:])
     sys.exit(0 if success else 1)
\ No newline at end of file
@@ -1,11 +1,20 @@
+from collections import Counter
+import hashlib
 import json
-import multiprocessing
+import os
+import pandas as pd
 import sys
 import time
 import xarray as xr
 from utility_constants import *
-from utility_functions import check_substrings_in_list, get_all_files_in_path
-from utility_e3sm_netcdf import get_netcdf_files_between_start_and_end_years
+from utility_functions import check_substrings_in_list, imap_unordered_with_executor, parse_command_line_arguments
+from utility_e3sm_netcdf import append_dataset_to_netcdf_file, estimate_memory_of_netcdf_variables, extract_gridcell_arrays_from_dataset, \
+                                extract_year_and_month_from_name_of_netcdf_file, find_gridcell_areas_in_netcdf_file, get_files_from_catalog, \
+                                get_netcdf_encoding, get_netcdf_file_type, get_region_matrix, get_static_grid_data, reduce_gridcell_arrays, update_file_catalog
+from utility_file_formats import write_dataframe_to_data_file
+
+""" Static grid data and region matrices for the time series (see get_time_series_grid_data()), keyed by simulation, type of NetCDF file, and regions. """
+time_series_grid_data = {}
 
 def process_inputs(inputs):    
     """ 
@@ -34,6 +43,20 @@ def process_inputs(inputs):
         if input_type in ['netcdf_substrings', 'variables'] and not isinstance(inputs[input_type][0], list):
             inputs[input_type] = [inputs[input_type] for i in range(len(inputs[input_type]))]
 
+    # The optional time series outputs (produced from the same read of the NetCDF files) follow the same rules, with defaults for each output file:
+    # no time series, the same variables as the spatial data, area-weighted aggregation, and the entire globe. Like the time series variables, 
+    # the time series regions are a list for each output file, so that the time series of several regions come from a single read of each file.
+    optional_input_types_and_defaults = {'time_series_output_files': None, 'time_series_variables': inputs['variables'], 
+                                         'lat_lon_aggregation_types': 'area_weighted_mean_or_sum', 'time_series_regions': None}
+    for input_type, default in optional_input_types_and_defaults.items():
+        inputs[input_type] = inputs.get(input_type, default)
+        if inputs[input_type] is None or isinstance(inputs[input_type], (str, int, float)):
+            inputs[input_type] = [inputs[input_type]]
+        if input_type in ['time_series_variables', 'time_series_regions'] and (not inputs[input_type] or not isinstance(inputs[input_type][0], list)):
+            inputs[input_type] = [inputs[input_type]]
+        if len(inputs[input_type]) == 1:
+            inputs[input_type] = inputs[input_type]*len(inputs['output_files'])
+
     # Now that the dictionary has been populated with complete data extraction options for each output file, separate it into a list of dictionaries,
     # where each of these smaller dictionaries contain the data extraction options for a single output file. Return this list of dictionaries.
     list_of_inputs = []
@@ -44,7 +67,14 @@ def process_inputs(inputs):
         start_years = inputs['start_years'][file_index]
         end_years = inputs['end_years'][file_index]
         inputs_for_this_output_file = {'simulation_path': inputs['simulation_path'], 'output_files': output_file, 'netcdf_substrings': netcdf_substrings}
+        inputs_for_this_output_file['catalog_directory'] = inputs.get('catalog_directory', None)
+        inputs_for_this_output_file['compression_level'] = inputs.get('compression_level', NETCDF_COMPRESSION_LEVEL)
+        inputs_for_this_output_file['convert_to_float32'] = inputs.get('convert_to_float32', False)
+        inputs_for_this_output_file['checkpoint_directory'] = inputs.get('checkpoint_directory', os.path.join(os.path.dirname(output_file) or '.', 'checkpoints'))
+        inputs_for_this_output_file['grid_cache_directory'] = inputs.get('grid_cache_directory', os.path.dirname(output_file) or '.')
         inputs_for_this_output_file.update({'variables': variables, 'start_years': start_years, 'end_years': end_years})
+        for input_type in optional_input_types_and_defaults:
+            inputs_for_this_output_file[input_type] = inputs[input_type][file_index]
         list_of_inputs.append(inputs_for_this_output_file)
     return list_of_inputs
 
@@ -80,6 +110,59 @@ def process_dataset(ds):
     
     return ds
 
+def assemble_spatial_data_from_checkpoints(inputs, checkpoint_files):
+    """ 
+    Assembles the annual-mean spatial data for an output file from the checkpoint files of its individual years (see 
+    extract_sums_and_counts_for_year()), adds the processed variables, writes the output file, and deletes the checkpoint files. 
+    The output file is written one year at a time, so that memory does not grow with the number of years. If a time series output file is 
+    specified, it is written as well.
+
+    Parameters:
+        inputs: Dictionary containing the user data-extraction inputs for a single output file. This dictionary is assumed to be complete.
+        checkpoint_files: List of the checkpoint files of all years of the output file.
+
+    Returns:
+        N/A.
+    """
+    output_file = inputs['output_files']
+    variables = inputs['variables']
+    if os.path.exists(output_file):
+        os.remove(output_file)
+
+    # Open the checkpoint files lazily, so that only the year being assembled is read into memory.
+    datasets = [xr.open_dataset(checkpoint_file) for checkpoint_file in checkpoint_files]
+    years = sorted({int(year) for dataset in datasets for year in dataset['year'].values})
+    for year in years:
+        # Add up the sums and counts of this year over the checkpoint files that contain it (a year can get months from the checkpoint files of 
+        # two years), and divide the sums by the counts to get the annual means.
+        ds_sums_and_counts = sum(dataset.sel(year=[year]) for dataset in datasets if year in dataset['year'].values)
+        ds = ds_sums_and_counts[variables].copy()
+        for variable in variables:
+            counts = ds_sums_and_counts[f'{variable}_count']
+            ds[variable] = (ds_sums_and_counts[variable]/counts.where(counts > 0)).astype(ds_sums_and_counts[variable].dtype)
+            ds[variable].attrs = datasets[0][variable].attrs
+
+        # Add total precipitation (in units of mm/year) and CO2 concentration variables to the Dataset, and append this year to the NetCDF file, 
+        # which is compressed and chunked by year.
+        ds = process_dataset(ds)
+        encoding = get_netcdf_encoding(ds, compression_level=inputs['compression_level'], convert_to_float32=inputs['convert_to_float32'])
+        append_dataset_to_netcdf_file(ds, output_file, 'year', encoding=encoding)
+
+    # Write the time series output file (if any) from the rows of all checkpoint files, sorted by year and month (with the regions of each month 
+    # kept in the order in which they were specified).
+    time_series_checkpoint_files = [get_time_series_checkpoint_file(checkpoint_file) for checkpoint_file in checkpoint_files]
+    if inputs['time_series_output_files']:
+        df = pd.concat([pd.read_csv(time_series_checkpoint_file) for time_series_checkpoint_file in time_series_checkpoint_files])
+        df.sort_values(['Year', 'Month'], inplace=True)
+        write_dataframe_to_data_file(df, inputs['time_series_output_files'])
+
+    # Delete the checkpoint files once the output files are complete.
+    for dataset in datasets:
+        dataset.close()
+    for checkpoint_file in checkpoint_files + time_series_checkpoint_files:
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
 def extract_spatial_data_from_netcdf_files(inputs):
     """ 
     Extracts time series data from E3SM-generated h0 NetCDF files of a particular type that are located in a simulation directory and puts this data 
@@ -91,53 +174,187 @@ def extract_spatial_data_from_netcdf_files(inputs):
     Returns:
         N/A.
     """
-    # Record the start time and extract all the user-chosen options from the inputs dictionary.
+    # Record the start time, extract each year into its checkpoint file, and then assemble the output file from the checkpoint files.
     start_time = time.time()
-    simulation_path = inputs['simulation_path']
-    output_file = inputs['output_files'] 
-    netcdf_substrings = inputs['netcdf_substrings'] 
-    variables = inputs['variables']  
-    start_year = inputs['start_years']   
-    end_year = inputs['end_years']   
-
-    # Get all NetCDF files for this particular type that fall within the specified start and end years.
-    netcdf_files = get_all_files_in_path(simulation_path, file_name_substrings=netcdf_substrings, file_extension='.nc')
-    netcdf_files = get_netcdf_files_between_start_and_end_years(netcdf_files, start_year, end_year)
-    
-    # Collect the NetCDF files (one for each month between the start and end years) in an xarray Dataset and store only the specified variables.
-    ds = xr.open_mfdataset(netcdf_files, decode_times=True, combine='nested', concat_dim='time', data_vars='minimal', parallel=True)[variables]
-    
-    # Shift output back by one month to get rid of the extra month (January in the next year after end_year) that somehow gets added.
-    ds['time'] = xr.CFTimeIndex(ds.get_index('time').shift(-1, 'ME'))
-
-    # Take the mean over all months in each year so that the Dataset records only an annual mean value for each variable at each lat/lon coordinate.
-    ds = ds.groupby('time.year').mean()
-
-    # Add total precipitation (in units of mm/year) and CO2 concentration variables to the Dataset.
-    ds = process_dataset(ds)
-
-    # Write the Dataset to a NetCDF file.
-    ds.to_netcdf(output_file, mode='w')
+    checkpoint_files = []
+    for year in range(inputs['start_years'], inputs['end_years']+1):
+        checkpoint_file = extract_sums_and_counts_for_year(inputs, year)
+        if checkpoint_file:
+            checkpoint_files.append(checkpoint_file)
+    assemble_spatial_data_from_checkpoints(inputs, checkpoint_files)
 
     # Print the time needed to create the smaller NetCDF file.
     end_time = time.time()
     elapsed_time = end_time - start_time
-    print(f"Elapsed time for {output_file}: {elapsed_time:.2f} seconds")
+    print(f"Elapsed time for {inputs['output_files']}: {elapsed_time:.2f} seconds")
+
+def extract_sums_and_counts_for_task(task):
+    """ 
+    Runs a single task of the scheduler in the main program, i.e., the extraction of one year for one output file.
+
+    Parameters:
+        task: Tuple of the index of the output file, the dictionary of inputs for the output file, and the year.
+
+    Returns:
+        Tuple of the index of the output file and the checkpoint file for the year (None if there are no NetCDF files for the year).
+    """
+    output_index, inputs, year = task
+    return output_index, extract_sums_and_counts_for_year(inputs, year)
+
+def extract_sums_and_counts_for_year(inputs, year):
+    """ 
+    Extracts the specified variables from the E3SM-generated h0 NetCDF files of a single year and writes their sums and numbers of valid values 
+    (counts) over the months of each year to a checkpoint file, from which assemble_spatial_data_from_checkpoints() later forms the annual means. 
+    Sums and counts are stored rather than means so that months that fall into a neighboring year (after the time shift below) are combined 
+    correctly. If a time series output file is specified, each monthly file is also reduced over the lat/lon coordinates of every region (as in 
+    e3sm_extract_time_series_h0.py) from the same read of the file, and the rows are written to a second checkpoint file. If resuming and the 
+    checkpoint file of this year already exists (e.g., from a job that ran out of wall time), it is not recomputed.
+
+    Parameters:
+        inputs: Dictionary containing the user data-extraction inputs for a single output file. This dictionary is assumed to be complete.
+        year: Year of the NetCDF files (from their names) to extract.
+
+    Returns:
+        Complete path of the checkpoint file, or None if there are no NetCDF files for this year.
+    """
+    variables = inputs['variables']
+    time_series_variables = inputs['time_series_variables'] if inputs['time_series_output_files'] else []
+    checkpoint_file = get_checkpoint_file(inputs, year)
+    if inputs.get('resume', False) and os.path.exists(checkpoint_file):
+        return checkpoint_file
+
+    # Get the NetCDF files for this particular type and year from the catalog of the simulation directory.
+    # The catalog has already been updated in the main process, so it is only queried here.
+    netcdf_files = get_files_from_catalog(inputs['simulation_path'], file_name_substrings=inputs['netcdf_substrings'], file_extension='.nc', 
+                                          start_year=year, end_year=year, catalog_directory=inputs['catalog_directory'], update_catalog=False)
+    if not netcdf_files:
+        return None
+
+    # For the time series, the static grid data of the entire globe and the region matrix (one row per region) are obtained once per process.
+    if time_series_variables:
+        grid_data, region_matrix = get_time_series_grid_data(netcdf_files[0], inputs['time_series_regions'], cache_directory=inputs['grid_cache_directory'])
+
+    # Read the NetCDF files (one for each month of the year) one at a time and accumulate the sums and counts over all months in each year, which 
+    # record the annual mean of each variable at each lat/lon coordinate. The files are read without dask, so that the only parallelism is that of 
+    # the scheduler in the main program, and memory is bounded by a single month plus the running sums and counts.
+    sums, counts, rows = {}, {}, []
+    for netcdf_file in netcdf_files:
+        if time_series_variables:
+            areas, ds_file, landfrac, non_landfrac = find_gridcell_areas_in_netcdf_file(netcdf_file, grid_data=grid_data)
+        else:
+            ds_file = xr.open_dataset(netcdf_file, decode_times=True)
+        with ds_file:
+            ds = ds_file[list(dict.fromkeys(variables + time_series_variables))].load()
+
+        # Reduce the time series variables over all regions at once from the data that have already been read. With more than one region, 
+        # each row is labeled by its region.
+        if time_series_variables:
+            arrays = extract_gridcell_arrays_from_dataset(ds, time_series_variables)
+            file_year, file_month = extract_year_and_month_from_name_of_netcdf_file(netcdf_file)
+            values = reduce_gridcell_arrays(arrays, inputs['lat_lon_aggregation_types'], areas, landfrac, non_landfrac, region_matrix=region_matrix)
+            for region_index, region in enumerate(inputs['time_series_regions']):
+                row = {'Region': region or 'global'} if len(inputs['time_series_regions']) > 1 else {}
+                row.update({'Year': file_year, 'Month': file_month, **{label: value[region_index] for label, value in values.items()}})
+                rows.append(row)
+
+        # Shift output back by one month to get rid of the extra month (January in the next year after end_year) that somehow gets added.
+        ds = ds[variables]
+        ds['time'] = xr.CFTimeIndex(ds.get_index('time').shift(-1, 'ME'))
+        for month_year, ds_month in ds.groupby('time.year'):
+            ds_sum = ds_month.sum('time')
+            ds_count = ds_month.notnull().sum('time')
+            sums[month_year] = sums[month_year] + ds_sum if month_year in sums else ds_sum
+            counts[month_year] = counts[month_year] + ds_count if month_year in counts else ds_count
+    years = sorted(sums)
+    ds_sums = xr.concat([sums[month_year] for month_year in years], dim='year').assign_coords(year=years)
+    ds_counts = xr.concat([counts[month_year] for month_year in years], dim='year').assign_coords(year=years)
+    ds_counts = ds_counts.rename({variable: f'{variable}_count' for variable in variables})
+    for variable in variables:
+        ds_sums[variable].attrs = ds[variable].attrs
+
+    # Write the checkpoint files under temporary names first, so that a job that is interrupted while writing does not leave a partial checkpoint.
+    # The time series checkpoint file is written first, so that the existence of the main checkpoint file means that the year is complete.
+    os.makedirs(inputs['checkpoint_directory'], exist_ok=True)
+    if time_series_variables:
+        time_series_checkpoint_file = get_time_series_checkpoint_file(checkpoint_file)
+        pd.DataFrame(rows).to_csv(time_series_checkpoint_file + '.tmp', index=False)
+        os.replace(time_series_checkpoint_file + '.tmp', time_series_checkpoint_file)
+    temporary_file = checkpoint_file + '.tmp'
+    xr.merge([ds_sums, ds_counts]).to_netcdf(temporary_file, mode='w')
+    os.replace(temporary_file, checkpoint_file)
+    return checkpoint_file
+
+def get_checkpoint_file(inputs, year):
+    """
+    Returns the name of the checkpoint file of the spatial data for a year of an output file. The name contains a hash of the inputs that determine
+    the contents of the checkpoint file (the complete paths of the simulation directory and output file, the NetCDF file substrings, the variables, 
+    and the time series options), so that resuming after any of these inputs has changed, or extracting two output files with the same name into 
+    the same checkpoint directory, never reuses a checkpoint file that was produced for different inputs.
+
+    Parameters:
+        inputs: Dictionary containing the user data-extraction inputs for a single output file. This dictionary is assumed to be complete.
+        year: Year of the NetCDF files (from their names) extracted into the checkpoint file.
+
+    Returns:
+        Complete path of the checkpoint file.
+    """
+    key = {'simulation_path': os.path.abspath(inputs['simulation_path']), 'output_files': os.path.abspath(inputs['output_files'])}
+    key.update({input_type: inputs[input_type] for input_type in ['netcdf_substrings', 'variables', 'time_series_output_files']})
+    if inputs['time_series_output_files']:
+        key.update({input_type: inputs[input_type] for input_type in ['time_series_variables', 'lat_lon_aggregation_types', 'time_series_regions']})
+    inputs_hash = hashlib.md5(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    return os.path.join(inputs['checkpoint_directory'], f"{os.path.basename(inputs['output_files'])}.{inputs_hash}.{year}.nc")
+
+def get_time_series_grid_data(netcdf_file, regions, cache_directory=None):
+    """
+    Gets the static grid data of the entire globe and the region matrix that are used to reduce the time series variables over every region at 
+    once. These do not change over the course of a simulation, so they are obtained only once per process for each simulation, type of NetCDF 
+    file, and list of regions, and then reused for all years. The static grid data are loaded from the cache file of get_static_grid_data() if it exists,
+    so that the worker processes do not need to compute them again, and they are never passed to the workers with the tasks.
+
+    Parameters:
+        netcdf_file: Any NetCDF file of the simulation and type of interest.
+        regions: List of strings for the regions of interest. None or 'global' indicates that the entire globe should be used.
+        cache_directory: Directory of the cache files of the static grid data (see get_static_grid_data()).
+
+    Returns:
+        Tuple of the dictionary of static grid data (see get_static_grid_data()) and the region matrix (see get_region_matrix()).
+    """
+    key = (os.path.dirname(os.path.abspath(netcdf_file)), get_netcdf_file_type(netcdf_file), tuple(regions))
+    if key not in time_series_grid_data:
+        time_series_grid_data[key] = (get_static_grid_data(netcdf_file, cache_directory=cache_directory), get_region_matrix(netcdf_file, regions))
+    return time_series_grid_data[key]
+
+def get_time_series_checkpoint_file(checkpoint_file):
+    """ 
+    Returns the name of the checkpoint file that stores the time series rows of a year, next to the checkpoint file of the spatial data.
+
+    Parameters:
+        checkpoint_file: Complete path of the checkpoint file of the spatial data for a year.
+
+    Returns:
+        Complete path of the time series checkpoint file.
+    """
+    return os.path.splitext(checkpoint_file)[0] + '.time_series.csv'
 
 
 ###---------------Begin execution---------------###
 if __name__ == '__main__':
 
-    # Run this script together with the input JSON file(s) on the command line.
+    # Run this script together with the input JSON file(s) on the command line. With --resume, years whose checkpoint files already exist 
+    # (e.g., from a previous job that ran out of wall time) are not extracted again. The optional --executor selects how the tasks are run 
+    # (multiprocessing on this node by default, or mpi or dask to spread them over several nodes).
     start_time = time.time()
-    if len(sys.argv) < 2:
-        print('Usage: python e3sm_extract_spatial_data_h0.py `path/to/json/input/file(s)\'')
+    input_files, options = parse_command_line_arguments(sys.argv[1:])
+    resume = options.get('resume', False)
+    executor = options.get('executor', EXECUTORS[0])
+    if len(input_files) < 1:
+        print('Usage: python e3sm_extract_spatial_data_h0.py [--resume] [--executor=multiprocessing|mpi|dask] `path/to/json/input/file(s)\'')
         sys.exit()
 
     # Read and load the JSON file(s) into a list of dictionaries.
     inputs = []
-    for index in range(1, len(sys.argv)):
-        input_file = sys.argv[index]
+    for input_file in input_files:
         with open(input_file) as f:
             inputs.extend(json.load(f))
 
@@ -146,9 +363,42 @@ if __name__ == '__main__':
     for index in range(len(inputs)):
         list_of_inputs_for_each_output_file.extend(process_inputs(inputs[index]))
 
-    # Create all output NetCDF files in parallel.
-    with multiprocessing.Pool(processes=MAX_PROCESSES) as pool:
-        pool.map(extract_spatial_data_from_netcdf_files, list_of_inputs_for_each_output_file)
+    # Update the file catalog of each simulation directory once, before the output files are created in parallel.
+    for simulation_path, catalog_directory in {(inputs['simulation_path'], inputs['catalog_directory']) for inputs in list_of_inputs_for_each_output_file}:
+        update_file_catalog(simulation_path, catalog_directory=catalog_directory)
+
+    # Split each output file into one task per year. A task reads one monthly NetCDF file at a time, so estimate its memory from the variables in 
+    # one file (the overhead factor of the estimate covers the running sums and counts).
+    tasks = []
+    memory_per_task = 0
+    for output_index, inputs in enumerate(list_of_inputs_for_each_output_file):
+        inputs['resume'] = resume
+        tasks.extend((output_index, inputs, year) for year in range(inputs['start_years'], inputs['end_years']+1))
+        netcdf_files = get_files_from_catalog(inputs['simulation_path'], file_name_substrings=inputs['netcdf_substrings'], file_extension='.nc', 
+                                              start_year=inputs['start_years'], end_year=inputs['end_years'], 
+                                              catalog_directory=inputs['catalog_directory'], update_catalog=False)
+        if netcdf_files:
+            memory_per_task = max(memory_per_task, estimate_memory_of_netcdf_variables(netcdf_files[0], list(dict.fromkeys(inputs['variables'] + inputs['time_series_variables']))))
+            # Compute the static grid data for the time series once here and save them to their cache file, from which the worker processes load 
+            # them (worker processes forked after this point already have them in memory).
+            if inputs['time_series_output_files']:
+                get_time_series_grid_data(netcdf_files[0], inputs['time_series_regions'], cache_directory=inputs['grid_cache_directory'])
+
+    # Extract all years of all output files in parallel, by default with the number of processes sized by the available memory. Each year is saved 
+    # to a checkpoint file as soon as it completes, and each output file is assembled from its checkpoint files (sorted by year) once all of its 
+    # years are done.
+    num_remaining_tasks = Counter(output_index for output_index, _, _ in tasks)
+    checkpoint_files_for_each_output = {output_index: [] for output_index in num_remaining_tasks}
+    for output_index, checkpoint_file in imap_unordered_with_executor(extract_sums_and_counts_for_task, tasks, executor=executor, 
+                                                                            memory_per_task=memory_per_task):
+        if checkpoint_file:
+            checkpoint_files_for_each_output[output_index].append(checkpoint_file)
+        num_remaining_tasks[output_index] -= 1
+        if num_remaining_tasks[output_index] == 0:
+            inputs = list_of_inputs_for_each_output_file[output_index]
+            assemble_spatial_data_from_checkpoints(inputs, sorted(checkpoint_files_for_each_output.pop(output_index)))
+            elapsed_time = time.time() - start_time
+            print(f"Elapsed time for {inputs['output_files']}: {elapsed_time:.2f} seconds")
 
     # Print the total execution time needed to complete all data extraction operations.
     end_time = time.time()
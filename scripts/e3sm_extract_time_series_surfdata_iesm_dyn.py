@@ -1,95 +1,82 @@
 import json
-import multiprocessing
 import numpy as np
 import pandas as pd
 import sys
 import time
 from utility_constants import *
-from utility_dataframes import move_columns_next_to_each_other_in_dataframe, write_dataframe_to_fwf
+from utility_file_formats import is_columnar_file, read_data_file_into_dataframe, write_dataframe_to_data_file
 from utility_functions import *
 from utility_e3sm_netcdf import *
 
-def extract_dataframe_rows_for_given_year(df, year):
+def extract_netcdf_file_into_dataframe_for_years(file, variables, region, years, grid_data=None):
     """ 
-    Processes the Pandas DataFrame so that it contains only the rows pertaining to the given year, where the year (or 'time') is a DataFrame index.
-
-    Parameters:
-        df: DataFrame of interest.
-        year: Year of interest.
-
-    Returns:
-        DataFrame containing only the rows for the given year, with the 'time' column dropped.
-    """
-    df = df.reset_index(['time'])
-    df = df[df['time'] == year].drop(columns=['time'])
-    return df
-
-def extract_netcdf_file_into_dataframe_single_year(file, variables, region, year):
-    """ 
-    For the given year, extracts the specified variables from the E3SM human component (EHC) land surface data file into a Pandas DataFrame. 
+    For the given years, extracts the specified variables from the E3SM human component (EHC) land surface data file into a Pandas DataFrame. 
+    The file is opened once, and the variables of all years are read together and reduced over the lat/lon coordinates in a single NumPy pass, 
+    with each variable held as a (years x grid cells) array.
 
     Parameters:
         file: NetCDF file generated by the EHC during run time. It contains data on land surface variables like harvest and grazing. 
-        variables: List of variables we want to extract from the NetCDF file. 
+        variables: List of variables we want to extract from the NetCDF file. Each variable must be defined only on the lat/lon coordinates 
+                   (plus the time dimension), except for PCT_NAT_PFT.
         region: String for the region of interest. If not specified or not recognized, then there will be no restrictions on the lat/lon coordinates. 
-        year: Year of interest.
+        years: List of years of interest.
+        grid_data: Dictionary of static grid data (areas, land fractions, regional selection) for the file, as returned by get_static_grid_data().
 
     Returns:
-        DataFrame containing one column for each of the variables, plus a column for the specific year of interest.
+        DataFrame containing one row for each of the years, with a column for the year and one column for each of the variables.
     """
     # Extract the area as a function of lat/lon coordinate from the NetCDF file and forms an xarray Dataset for the variables.
-    areas, ds, _, _ = find_gridcell_areas_in_netcdf_file(file, region=region)
+    areas, ds, _, _ = find_gridcell_areas_in_netcdf_file(file, region=region, grid_data=grid_data)
+    areas = areas.reshape(-1)
 
     # Drop duplicate 'time' coordinate values (e.g., that get generated during restarts), keeping the data that correspond to the last occurrence.
+    # Then read only the time steps of the years of interest.
     ds = ds.drop_duplicates(dim='time', keep='last')
+    time_values = ds['time'].to_numpy()
+    ds = ds.isel(time=[int(np.flatnonzero(time_values == year)[0]) for year in years])
+    shape = (len(years), areas.size)
 
     # If grazing or harvest are of interest, make sure to also extract the land fractions for vegetation and the plant-functional types (PFTs).
+    variables = list(variables)
     if 'GRAZING' in variables or any('HARVEST_' in variable for variable in variables):
         if 'PCT_NAT_PFT' not in variables:
             variables.append('PCT_NAT_PFT')
         if 'PCT_NATVEG' not in variables:
-            variables.append('PCT_NATVEG')        
+            variables.append('PCT_NATVEG')
 
-    # Convert the Dataset to create an overall DataFrame that stores all variables except those for land fractions and PFTs. 
-    # Create a second DataFrame to store the land fractions and PFTs. 
-    variables_except_pfts = variables.copy()
-    variables_pfts = []
-    if 'PCT_NAT_PFT' in variables:
-        variables_except_pfts.remove('PCT_NAT_PFT')
-        variables_pfts.append('PCT_NAT_PFT')
-    if variables_except_pfts:
-        df = ds[variables_except_pfts].to_dataframe()
-        # Reduce the DataFrame to only the rows for the specific year of interest.
-        df = extract_dataframe_rows_for_given_year(df, year)
-    if variables_pfts:
-        df_pfts = ds[variables_pfts].to_dataframe()
-        df_pfts = extract_dataframe_rows_for_given_year(df_pfts, year)
-
-    # Divide the vegetation percent by 100 to change it to a fraction and update the label accordingly.
-    if 'PCT_NATVEG' in variables:
-        df['PCT_NATVEG'] = df['PCT_NATVEG'].fillna(0)/100
-        df = df.rename(columns={'PCT_NATVEG': 'FRAC_VEG'})
-
-    # Add a column for the area at each lat/lon coordinate to the overall DataFrame.
-    df['AREA (km^2)'] = areas
+    # Store each variable except the PFT percentages as a (years x grid cells) array, where the grid cells are in the same order as the areas. 
+    # Variables without a time dimension are the same for all years. Divide the vegetation percent by 100 to change it to a fraction.
+    columns = {}
+    for variable in variables:
+        if variable == 'PCT_NAT_PFT':
+            continue
+        da = ds[variable]
+        values = da.transpose('time', ...).to_numpy() if 'time' in da.dims else da.to_numpy()[np.newaxis]
+        values = np.broadcast_to(values.reshape(values.shape[0], -1), shape)
+        if variable == 'PCT_NATVEG':
+            columns['FRAC_VEG'] = np.where(np.isnan(values), 0, values)/100
+        else:
+            columns[variable] = values
+    labels = ['FRAC_VEG' if variable == 'PCT_NATVEG' else variable for variable in variables if variable != 'PCT_NAT_PFT']
+
+    # Add the area at each lat/lon coordinate.
+    columns['AREA (km^2)'] = np.broadcast_to(areas, shape)
+    labels.append('AREA (km^2)')
 
     # 17 PFTs in order: 1 bare, 8 tree, 3 shrub, 3 grass, 1 crop, 1 empty. These can be further subgrouped as follows:
     # Bare soil (index 0), forest (the 8 trees, indices 1--8); shrub (indices 9--11); grass (indices 12--14), crop (index 15). Ignore the empty PFT.
     if 'PCT_NAT_PFT' in variables:
-        df_pfts = df_pfts.reset_index(level='natpft')
-        # Get data for the individual PFTs (again ignoring the empty one), as well as the aggregate subgroups.
-        pft_labels = [f'PFT_{i+1}_AREA (km^2)' for i in range(16)]
-        pft_labels.extend(['BARE_AREA (km^2)', 'FOREST_AREA (km^2)', 'SHRUB_AREA (km^2)', 'GRASS_AREA (km^2)', 'CROP_AREA (km^2)'])
-        pft_min_max_indices = [(i, i) for i in range(16)]
-        pft_min_max_indices.extend([(0, 0), (1, 8), (9, 11), (12, 14), (15, 15)])
-        # Select only the rows that pertain to this particular PFT category and for each lat/lon coordinate, sum over all PFTS if a subgroup.
-        for index, pft_label in enumerate(pft_labels):
-            pft_min_index, pft_max_index = pft_min_max_indices[index][0], pft_min_max_indices[index][1]
-            df_this_pft = df_pfts[(df_pfts['natpft'] >= pft_min_index) & (df_pfts['natpft'] <= pft_max_index)]
-            # Add up the percentages over all PFTs in the subgroup and divide that total percent by 100 to change it to a fraction.
-            df_this_pft = df_this_pft['PCT_NAT_PFT'].groupby(['lsmlat', 'lsmlon']).sum().fillna(0)/100
-            # Add a column to the overall DataFrame to record the area of this PFT category (individual or subgroup) at each lat/lon coordinate.
-            df[pft_label] = df['AREA (km^2)']*df['FRAC_VEG']*df_this_pft      
+        # Read the PFT percentages of all years, with missing values treated as zero, and change them to fractions.
+        pct_nat_pft = ds['PCT_NAT_PFT'].transpose('time', 'natpft', ...).fillna(0).to_numpy()/100
+        # Get the fractions of all individual PFTs (again ignoring the empty one) and aggregate subgroups in each grid cell and year from a single 
+        # contraction of the PFT fractions with the membership matrix over the PFT axis.
+        pft_labels, pft_membership_matrix = create_pft_membership_matrix(pct_nat_pft.shape[1])
+        pft_fractions = np.tensordot(pft_membership_matrix, pct_nat_pft, axes=([1], [1])).reshape(len(pft_labels), *shape)
+        # Record the area of each PFT category (individual or subgroup) at each lat/lon coordinate.
+        vegetated_areas = columns['AREA (km^2)']*columns['FRAC_VEG']
+        for pft_label, fractions in zip(pft_labels, pft_fractions):
+            columns[pft_label] = vegetated_areas*fractions
+        labels.extend(pft_labels)
 
     # Convert the grazing and harvest variables from a unitless fraction into an area by multiplying with the area of the PFT aggregate subgroup.
     grazing_harvest_variables = ['GRAZING', 'HARVEST_SH1', 'HARVEST_SH2', 'HARVEST_SH3', 'HARVEST_VH1', 'HARVEST_VH2']
@@ -97,29 +84,59 @@ def extract_netcdf_file_into_dataframe_single_year(file, variables, region, year
                           'FOREST_AREA (km^2)']
     for index in range(len(grazing_harvest_variables)):
         grazing_harvest_variable = grazing_harvest_variables[index]
-        df[grazing_harvest_variable] = df[grazing_harvest_variable]*df[pft_area_columns[index]]
-        df = df.rename(columns={grazing_harvest_variable: grazing_harvest_variable + '_AREA (km^2)'})
-    
-    # Create another column for the total harvest, which is the sum of all the harvest variables present in the DataFrame.
+        if grazing_harvest_variable in columns:
+            columns[grazing_harvest_variable + '_AREA (km^2)'] = columns.pop(grazing_harvest_variable)*columns[pft_area_columns[index]]
+            labels[labels.index(grazing_harvest_variable)] = grazing_harvest_variable + '_AREA (km^2)'
+
+    # Create another column for the total harvest, which is the sum of all the harvest variables present, placed after the last of them.
     harvest_variables = ['HARVEST_SH1_AREA (km^2)', 'HARVEST_SH2_AREA (km^2)', 'HARVEST_SH3_AREA (km^2)', 'HARVEST_VH1_AREA (km^2)', 
                          'HARVEST_VH2_AREA (km^2)']
-    harvest_variables = [x for x in harvest_variables if x in df.columns]
+    harvest_variables = [x for x in harvest_variables if x in columns]
     if harvest_variables:
-        df['HARVEST_AREA (km^2)'] = df[harvest_variables].sum(axis=1)
-        df = move_columns_next_to_each_other_in_dataframe(df, harvest_variables[len(harvest_variables)-1], 'HARVEST_AREA (km^2)')
-    
-    # Sum over all latitude/longitude coordinates to get an area-weighted sum for each variable.
-    df['FRAC_VEG'] *= df['AREA (km^2)']
-    df = df.sum().to_frame().T
+        columns['HARVEST_AREA (km^2)'] = np.nansum(np.stack([columns[x] for x in harvest_variables]), axis=0)
+        labels.insert(labels.index(harvest_variables[-1]) + 1, 'HARVEST_AREA (km^2)')
+
+    # Sum over all latitude/longitude coordinates to get an area-weighted sum for each variable and year. Broadcast arrays are made contiguous 
+    # first, so that each row is summed in the same order as a single year (and the results are identical to extracting the years one by one).
+    columns['FRAC_VEG'] = columns['FRAC_VEG']*columns['AREA (km^2)']
+    df = pd.DataFrame({label: np.nansum(np.ascontiguousarray(columns[label]), axis=1) for label in labels})
 
     # Vegetation fraction should be an area-weighted mean, and not an area-weighted sum, so we should divide its sum by the total area.
     df['FRAC_VEG'] /= np.sum(areas)
 
     # Add year column.
-    column_names_with_year_first = ['Year']
-    column_names_with_year_first.extend(df.columns)
-    df['Year'] = year
-    return df[column_names_with_year_first]
+    df.insert(0, 'Year', years)
+    ds.close()
+    return df
+
+def extract_netcdf_file_into_dataframe_for_task(task):
+    """ 
+    Runs a single task of the scheduler in extract_time_series_from_netcdf_files(), i.e., the extraction of a block of years for one output file.
+
+    Parameters:
+        task: Tuple of the index of the output file and the arguments for extract_netcdf_file_into_dataframe_for_years().
+
+    Returns:
+        Tuple of the index of the output file and the DataFrame for the block of years.
+    """
+    output_index, arguments = task
+    return output_index, extract_netcdf_file_into_dataframe_for_years(*arguments)
+
+def extract_netcdf_file_into_dataframe_single_year(file, variables, region, year, grid_data=None):
+    """ 
+    For the given year, extracts the specified variables from the E3SM human component (EHC) land surface data file into a Pandas DataFrame. 
+
+    Parameters:
+        file: NetCDF file generated by the EHC during run time. It contains data on land surface variables like harvest and grazing. 
+        variables: List of variables we want to extract from the NetCDF file. 
+        region: String for the region of interest. If not specified or not recognized, then there will be no restrictions on the lat/lon coordinates. 
+        year: Year of interest.
+        grid_data: Dictionary of static grid data (areas, land fractions, regional selection) for the file, as returned by get_static_grid_data().
+
+    Returns:
+        DataFrame containing one column for each of the variables, plus a column for the specific year of interest.
+    """
+    return extract_netcdf_file_into_dataframe_for_years(file, variables, region, [year], grid_data=grid_data)
 
 def extract_time_series_from_netcdf_file(inputs):
     """ 
@@ -130,59 +147,157 @@ def extract_time_series_from_netcdf_file(inputs):
         inputs: Dictionary containing the user choice inputs for different options, such as the variables that they want to extract from the file. 
 
     Returns:
-        DataFrame containing one column for each of the variables, plus a column for the year.
+        N/A.
+    """
+    extract_time_series_from_netcdf_files([inputs])
+
+def extract_time_series_from_netcdf_files(list_of_inputs, executor=EXECUTORS[0]):
+    """ 
+    Produces the time series output files for all of the given inputs (e.g., all blocks in the JSON files) with a single scheduler. 
+    The (output file, block of years) units of work of all output files are flattened into one list of tasks that is processed by one persistent pool 
+    of workers, and each output file is written as soon as all of its tasks have completed. This keeps all workers busy from start to end, 
+    instead of idling while each output file is assembled and written before the next one is started.
+
+    Parameters:
+        list_of_inputs: List of dictionaries containing the user choice inputs for each output file.
+        executor: Executor that runs the tasks (see imap_unordered_with_executor() in utility_functions.py).
+
+    Returns:
+        N/A.
+    """
+    start_time = time.time()
+
+    # Prepare the tasks of all output files. Output files without anything to extract (in incremental mode) are skipped.
+    # Each task reads the variables of its block of years, so its memory is estimated from the full variables (conservatively including the PFT 
+    # variables that are added for grazing and harvest) scaled by the fraction of the time steps in the file that the block covers.
+    tasks, num_remaining_tasks, existing_dataframes = [], {}, {}
+    memory_per_task = 0
+    for output_index, inputs in enumerate(list_of_inputs):
+        arguments, df_existing = prepare_time_series_extraction(inputs)
+        if not arguments:
+            continue
+        tasks.extend((output_index, arguments_for_year) for arguments_for_year in arguments)
+        num_remaining_tasks[output_index] = len(arguments)
+        existing_dataframes[output_index] = df_existing
+        file, variables, years_per_task = arguments[0][0], arguments[0][1], max(len(arguments_for_task[3]) for arguments_for_task in arguments)
+        with xr.open_dataset(file) as ds:
+            fraction_of_time_steps = min(1, years_per_task/ds.sizes['time'])
+        memory_of_all_time_steps = estimate_memory_of_netcdf_variables(file, variables + ['PCT_NAT_PFT', 'PCT_NATVEG'])
+        memory_per_task = max(memory_per_task, fraction_of_time_steps*memory_of_all_time_steps)
+    if not tasks:
+        return
+
+    # Process the tasks in order of the output files, but collect their results as they complete. With the default executor, the pool is sized by 
+    # the available memory, and tasks are held back while memory is short. Write each output file once all of its blocks have been extracted 
+    # (the years are sorted before writing, so the output does not depend on the order in which the tasks complete).
+    dataframes_for_each_output = {output_index: [] for output_index in num_remaining_tasks}
+    for output_index, df in imap_unordered_with_executor(extract_netcdf_file_into_dataframe_for_task, tasks, executor=executor, 
+                                                         memory_per_task=memory_per_task):
+        dataframes_for_each_output[output_index].append(df)
+        num_remaining_tasks[output_index] -= 1
+        if num_remaining_tasks[output_index] == 0:
+            inputs = list_of_inputs[output_index]
+            write_time_series_to_file(inputs, dataframes_for_each_output.pop(output_index), existing_dataframes.pop(output_index))
+            elapsed_time = time.time() - start_time
+            print(f"Elapsed time for {inputs['output_file']}: {elapsed_time:.2f} seconds")
+
+def prepare_time_series_extraction(inputs):
+    """ 
+    Prepares the extraction of a time series from the surfdata_iESM_dyn.nc file of a simulation: determines the years to extract and gets the 
+    static grid data that are shared by all years.
+
+    Parameters:
+        inputs: Dictionary containing the user choice inputs for different options, such as the variables that they want to extract from the file. 
+
+    Returns:
+        List containing the arguments for extract_netcdf_file_into_dataframe_for_years() for each block of years to extract (empty if there is 
+        nothing to extract), and the DataFrame of the existing output file in incremental mode (None otherwise).
     """
-    # Extract all user selections, some being supplied with default choices. Calculate the total number of years. Set the path and name of the file.
+    # Extract all user selections, some being supplied with default choices. Set the path and name of the file.
     simulation_path = inputs['simulation_path']
     output_file = inputs['output_file']
     variables = inputs['variables']
     region = inputs.get('region', None)
-    write_to_csv = inputs.get('write_to_csv', False)
     start_year = inputs.get('start_year', 2015)
     end_year = inputs.get('end_year', 2100)
-    num_years = end_year - start_year + 1
+    grid_cache_directory = inputs.get('grid_cache_directory', os.path.dirname(output_file) or '.')
+    incremental = inputs.get('incremental', False)
+    years_per_task = inputs.get('years_per_task', 10)
+    years = list(range(start_year, end_year+1))
     file = os.path.join(simulation_path, 'surfdata_iESM_dyn.nc')
 
-    # Use multiprocessing to extract data from the file for each individual year. 
-    # Put the data from each year into DataFrame and store all such DataFrames in a list.
-    arguments = list(zip([file]*num_years, [variables]*num_years, [region]*num_years, range(start_year, end_year+1)))
-    with multiprocessing.Pool(processes=MAX_PROCESSES) as pool:
-        dataframes_for_each_year = list(pool.starmap(extract_netcdf_file_into_dataframe_single_year, arguments))
+    # In incremental mode (e.g., for a simulation that is still running), keep the rows already in the output file and only extract the years 
+    # that have been written to the NetCDF file since then. If the NetCDF file has been modified after the output file was written, the last year 
+    # already in the output file is extracted again, since it may have been rewritten (e.g., after a restart).
+    df_existing = None
+    if incremental and os.path.isfile(output_file):
+        df_existing = read_data_file_into_dataframe(output_file)
+        existing_years = set(df_existing['Year'])
+        last_existing_year = max(existing_years) if existing_years else None
+        file_modified = os.path.getmtime(file) > os.path.getmtime(output_file)
+        with xr.open_dataset(file) as ds:
+            years_in_file = set(ds['time'].to_numpy().astype(int))
+        years = [year for year in years if year in years_in_file and (year not in existing_years or (file_modified and year == last_existing_year))]
+        if not years:
+            print(f"No new years to extract for {output_file}")
+            return [], df_existing
+
+    # The grid cell areas, land fractions, and regional selection are the same for every year, so compute (or load) them once and pass them 
+    # to all the processes instead of recomputing them for each year. Split the years into blocks, each of which is extracted in one pass.
+    grid_data = get_static_grid_data(file, region=region, cache_directory=grid_cache_directory)
+    blocks_of_years = [years[index:index+years_per_task] for index in range(0, len(years), years_per_task)]
+    arguments = [(file, variables, region, block_of_years, grid_data) for block_of_years in blocks_of_years]
+    return arguments, df_existing
+
+def write_time_series_to_file(inputs, dataframes_for_each_year, df_existing=None):
+    """ 
+    Combines the DataFrames for the individual years into a single time series and writes it to the output file.
+
+    Parameters:
+        inputs: Dictionary containing the user choice inputs for different options, such as the output file. 
+        dataframes_for_each_year: List of DataFrames (in any order), each containing the rows for one or more years.
+        df_existing: DataFrame of the existing output file in incremental mode. Years that were extracted again replace its rows.
+
+    Returns:
+        N/A.
+    """
+    output_file = inputs['output_file']
+    write_to_csv = inputs.get('write_to_csv', False)
 
     # Concatenate all DataFrames in the list together to form a single DataFrame over all years. Sort by year.
     df = pd.concat(dataframes_for_each_year)
+    # In incremental mode, append the new rows to the existing ones. Years that were extracted again replace the rows already in the output file.
+    if df_existing is not None:
+        df = pd.concat([df_existing, df]).drop_duplicates(subset=['Year'], keep='last')
     df.sort_values(['Year'], inplace=True)  
 
-    # Write the DataFrame to the specified output file.
-    if write_to_csv or output_file.endswith('.csv'):
+    # Write the DataFrame to the specified output file. The format is chosen from the file extension, e.g., a binary columnar format (Parquet or 
+    # Feather) that is much faster to read for plotting.
+    if write_to_csv and not is_columnar_file(output_file):
         df.to_csv(output_file, index=False)
     else:
-        write_dataframe_to_fwf(output_file, df)
+        write_dataframe_to_data_file(df, output_file)
 
 
 ###---------------Begin execution---------------###
 if __name__ == '__main__':
 
-    # Run this script together with the input JSON file(s) on the command line.
+    # Run this script together with the input JSON file(s) on the command line. The optional --executor selects how the tasks are run 
+    # (multiprocessing on this node by default, or mpi or dask to spread them over several nodes).
     start_time_total = time.time()
-    if len(sys.argv) < 2:
-        print('Usage: python e3sm_extract_time_series_surfdata_iesm_dyn.py `path/to/json/input/file(s)\'')
+    input_files, options = parse_command_line_arguments(sys.argv[1:])
+    if len(input_files) < 1:
+        print('Usage: python e3sm_extract_time_series_surfdata_iesm_dyn.py [--executor=multiprocessing|mpi|dask] `path/to/json/input/file(s)\'')
         sys.exit()
 
     # Read and load the JSON file(s) into a list of dictionaries. Each block in a JSON file represents one time series output file.
     list_of_inputs = []
-    for index in range(1, len(sys.argv)):
-        input_file = sys.argv[index]
+    for input_file in input_files:
         with open(input_file) as f:
             list_of_inputs.extend(json.load(f))
 
-    # Produce the output files one at a time.
-    for inputs in list_of_inputs:
-        start_time = time.time()
-        extract_time_series_from_netcdf_file(inputs)
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        print(f"Elapsed time for {inputs['output_file']}: {elapsed_time:.2f} seconds")
+    # Produce all output files with a single scheduler and pool of workers, writing each output file as soon as all of its years are extracted.
+    extract_time_series_from_netcdf_files(list_of_inputs, executor=options.get('executor', EXECUTORS[0]))
     
     # Print the total execution time needed to complete all data extraction operations.
     end_time = time.time()
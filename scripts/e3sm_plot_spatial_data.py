@@ -1,7 +1,6 @@
 import cartopy.crs as ccrs
 import json
 from matplotlib import pyplot as plt
-import multiprocessing
 import numpy as np
 import os
 import pandas as pd
@@ -11,10 +10,12 @@ import time
 import uxarray as ux
 import xarray as xr
 from utility_constants import *
-from utility_dataframes import perform_ttest
-from utility_functions import check_is_list_of_lists, print_p_values, replace_inside_parentheses, sort_file, transpose_scenarios_if_needed
+from utility_e3sm_netcdf import estimate_memory_of_netcdf_variables
+from utility_functions import check_is_list_of_lists, create_process_pool, imap_unordered_in_process_pool, parse_command_line_arguments, \
+                              print_p_values, replace_inside_parentheses, sort_file, transpose_scenarios_if_needed
 from utility_plots import *
-from utility_xarray import calculate_statistics_of_xarray, convert_xarray_to_uxarray
+from utility_statistics import calculate_p_values_for_dataframe_rows
+from utility_xarray import calculate_statistics_of_xarray, convert_xarray_to_uxarray, open_grid
 
 """ Dictionary of default input values for spatial plots. """
 default_inputs = {
@@ -145,6 +146,100 @@ def process_inputs(inputs):
         list_of_inputs.append(inputs_for_this_variable)
     return list_of_inputs
 
+def get_time_reduction_of_variable(inputs, file):
+    """
+    Gets the mean or sum (depending on the time calculation) over the years between the start and end years of the variable to plot from a 
+    NetCDF file. If the time reductions of all variables were loaded at once by load_time_reductions_for_plots(), that reduction is used.
+    Otherwise, the file is read for this variable alone.
+
+    Parameters:
+        inputs: Dictionary containing the complete (pre-processed) plotting options for a single variable.
+        file: Path and name of the NetCDF file.
+
+    Returns:
+        xarray Dataset containing only the time reduction of the variable.
+    """
+    time_reductions = inputs.get('time_reductions')
+    if time_reductions and file in time_reductions:
+        return time_reductions[file]
+    variables_and_time_calculations = [(inputs['variable'], inputs['time_calculation'])]
+    return reduce_netcdf_file_over_years(file, inputs['start_year'], inputs['end_year'], variables_and_time_calculations)[variables_and_time_calculations[0]]
+
+def load_time_reductions_for_plots(list_of_inputs):
+    """
+    Reads each NetCDF file needed by a list of plots only once for all variables that are plotted from it, instead of once per variable, and 
+    adds the resulting time reductions to the inputs of each plot. The files are read in parallel, so that the later plotting tasks only 
+    need to calculate the ensemble statistics and render the plots from these small in-memory arrays.
+
+    Parameters:
+        list_of_inputs: List of dictionaries, each of which contains the complete (pre-processed) plotting options for a single variable.
+            The time reductions of the variable for each of its files are added to each dictionary under the key 'time_reductions'.
+
+    Returns:
+        N/A.
+    """
+    # Collect all the variables (and their time calculations) that need to be read from each file for each range of years.
+    variables_for_each_file = {}
+    for inputs in list_of_inputs:
+        for file in [file for files in inputs['netcdf_files'] for file in files]:
+            key = (file, inputs['start_year'], inputs['end_year'])
+            variables_for_each_file.setdefault(key, set()).add((inputs['variable'], inputs['time_calculation']))
+    tasks = [(*key, sorted(variables_and_time_calculations)) for key, variables_and_time_calculations in variables_for_each_file.items()]
+
+    # Read the files in parallel, with the number of processes sized by the memory needed to read the variables of the largest file. The memory is 
+    # estimated from the shapes of the variables, since the sizes of compressed NetCDF files greatly underestimate it.
+    time_reductions = {}
+    memory_per_task = max(estimate_memory_of_netcdf_variables(file, [variable for variable, _ in variables_and_time_calculations]) 
+                          for (file, _, _), variables_and_time_calculations in variables_for_each_file.items())
+    for key, time_reductions_for_file in imap_unordered_in_process_pool(reduce_netcdf_file_over_years_for_task, tasks, memory_per_task=memory_per_task):
+        time_reductions[key] = time_reductions_for_file
+
+    # Give each plot only the time reductions of its own variable.
+    for inputs in list_of_inputs:
+        inputs['time_reductions'] = {}
+        for file in [file for files in inputs['netcdf_files'] for file in files]:
+            key = (file, inputs['start_year'], inputs['end_year'])
+            inputs['time_reductions'][file] = time_reductions[key][(inputs['variable'], inputs['time_calculation'])]
+
+def reduce_netcdf_file_over_years(file, start_year, end_year, variables_and_time_calculations):
+    """
+    Reads the data between the start and end years of several variables from a NetCDF file at once and calculates either the mean or sum 
+    over these years for each variable.
+
+    Parameters:
+        file: Path and name of the NetCDF file.
+        start_year: First year of the data to read.
+        end_year: Last year of the data to read.
+        variables_and_time_calculations: List of (variable, time_calculation) tuples, where time_calculation is either 'mean' or 'sum'.
+
+    Returns:
+        Dictionary whose keys are the (variable, time_calculation) tuples and whose values are xarray Datasets containing only the time 
+        reduction of that variable.
+    """
+    variables = sorted({variable for variable, _ in variables_and_time_calculations})
+    with xr.open_dataset(file) as ds:
+        ds = ds.sel(year=slice(start_year, end_year))[variables].load()
+    time_reductions = {}
+    for variable, time_calculation in variables_and_time_calculations:
+        if time_calculation == 'mean':
+            time_reductions[(variable, time_calculation)] = ds[[variable]].mean(dim='year')
+        elif time_calculation == 'sum':
+            time_reductions[(variable, time_calculation)] = ds[[variable]].sum(dim='year')
+    return time_reductions
+
+def reduce_netcdf_file_over_years_for_task(task):
+    """
+    Calls reduce_netcdf_file_over_years() for a single task, so that it can be run in a process pool.
+
+    Parameters:
+        task: Tuple of the file, start year, end year, and list of (variable, time_calculation) tuples.
+
+    Returns:
+        Tuple of the (file, start_year, end_year) key of the task and the dictionary returned by reduce_netcdf_file_over_years().
+    """
+    file, start_year, end_year, variables_and_time_calculations = task
+    return (file, start_year, end_year), reduce_netcdf_file_over_years(file, start_year, end_year, variables_and_time_calculations)
+
 def plot_spatial_data_eam(inputs, grid_file):
     """ 
     Creates spatial plots and perform statistical analysis for a single variable from E3SM EAM outputs. 
@@ -190,8 +285,8 @@ def plot_spatial_data_eam(inputs, grid_file):
     use_latex = inputs['use_latex']
     width = inputs['width'] 
  
-    # Store the grid file in an uxarray Dataset.
-    grid = ux.open_grid(grid_file)
+    # Store the grid file in an uxarray Grid, which is only parsed once per process for all variables that the process plots.
+    grid = open_grid(grid_file)
 
     # We either have individual plots, in which case there could be multiple files arranged like [[file1, file2, file3, ...]],
     # or we could have ensemble plots, in which case there are at most two data sets, but potentially multiple files in each of the sets.
@@ -218,14 +313,9 @@ def plot_spatial_data_eam(inputs, grid_file):
     for file_set_index in range(num_file_sets):
         for file_index in range(num_files_in_each_set):
             file = netcdf_files[file_index][file_set_index]
-            # Create a temporary NetCDF file with data between only the start and end years. 
-            ds = xr.open_dataset(file).sel(year=slice(start_year, end_year))[variable]
-            file = os.path.join(plot_directory, f'temp_{variable}.nc')
-            ds.to_netcdf(file, 'w')
-            if time_calculation == 'mean':
-                uxda = ux.open_dataset(grid_file, file).mean(dim='year')[variable]*multiplier
-            elif time_calculation == 'sum':
-                uxda = ux.open_dataset(grid_file, file).sum(dim='year')[variable]*multiplier
+            # Get the mean or sum of the data between the start and end years and attach it to the grid in memory.
+            uxda = ux.UxDataset.from_xarray(get_time_reduction_of_variable(inputs, file), grid)[variable]*multiplier
+            if time_calculation == 'sum':
                 # If calculating the sum, change the per-time quantities and their units accordingly.
                 per_time_labels = ['/year', '/month', '/day', '/hour', '/min', '/s']
                 time_multipliers = np.array([1, years_TO_months, years_TO_days, years_TO_hours, years_TO_mins, years_TO_s])
@@ -239,8 +329,6 @@ def plot_spatial_data_eam(inputs, grid_file):
             if num_file_sets >= 2:
                 uxda = uxda.rename(f'{variable}_{file_index}_{file_set_index}')
             uxds[uxda.name] = uxda
-            # Delete the temporary NetCDF file now that the data have been read.
-            os.system(f'rm {file}')
     
     # Initialize list that will store all the uxarray DataArrays that we will want to plot for the variable.
     uxDataArrays_to_plot = []
@@ -292,8 +380,7 @@ def plot_spatial_data_eam(inputs, grid_file):
         if num_files_in_each_set >= 2 and plot_type != 'separate_plots':
             df = uxds.to_dataframe()
             df = df.groupby(['lat', 'lon']).mean()
-            da_pvalues = df.apply(perform_ttest, columns_set_1=columns_control_set, \
-                                columns_set_2=columns_test_set, axis=1).fillna(1).to_xarray().fillna(1)
+            da_pvalues = calculate_p_values_for_dataframe_rows(df, columns_control_set, columns_test_set).fillna(1).to_xarray().fillna(1)
             #uxda_pvalues = convert_xarray_to_uxarray(da_pvalues, grid, variable=variable, fillna=1)
 
     # Iterate over all uxDataArrays in the list to create a plot for each one.
@@ -311,27 +398,34 @@ def plot_spatial_data_eam(inputs, grid_file):
         if plot_type == 'percent_difference' and not cbar_limits and max > 100:
             cbar_limits = [-100, 100]
 
-        # Plot the uxDataArray and optionally add the title and colorbar.
-        fig = plt.figure(figsize=(width, height))
-        ax = fig.add_axes([0.1, 0.1, 0.8, 0.8], projection=projection())
+        # Extra for the colorbar padding in case using the default (not LaTeX) font.
+        if cbar_on and not use_latex and cbar_x_offset < 0.09:
+            cbar_x_offset = 0.09
+
+        # Plot the uxDataArray on the map template for this layout and grid, which is built only once per process. The first map drawn with the 
+        # template creates the PolyCollection of the grid cells, while the following maps only update its data and color limits.
+        template = get_map_template(projection, width, height, key=(grid_file, cbar_on, cbar_x_offset))
+        fig, ax = template['fig'], template['ax']
         uxda = uxda[variable]
-        uxda_fig = uxda.to_polycollection(cache=True)
-        uxda_fig.set_transform(ccrs.PlateCarree())
+        if template['data_artist'] is None:
+            # Find the grid cell drawn by each polygon, since the PolyCollection excludes the grid cells that cross the antimeridian.
+            template['face_indices'] = np.asarray(uxda.copy(data=np.arange(uxda.size, dtype=float)).to_polycollection(cache=True).get_array()).astype(int)
+            template['data_artist'] = uxda.to_polycollection(cache=True)
+            template['data_artist'].set_transform(ccrs.PlateCarree())
+            ax.add_collection(template['data_artist'])
+            ax.set_global()
+        uxda_fig = template['data_artist']
+        uxda_fig.set_array(uxda.values[template['face_indices']])
         uxda_fig.set_cmap(cmap_color)
+        uxda_fig.norm.autoscale(uxda_fig.get_array())
         ax.set_title(title)
-        ax.add_collection(uxda_fig)
-        ax.set_global()
         if title:
             plt.rcParams['axes.titlesize'] = title_size
             ax.set_title(title)
         if cbar_on:
-            # Extra for the colorbar padding in case using the default (not LaTeX) font.
-            if not use_latex and cbar_x_offset < 0.09:
-                cbar_x_offset = 0.09
-            cbar_ax = fig.add_axes([ax.get_position().x1+cbar_x_offset, ax.get_position().y0, 0.02, ax.get_position().height])
             if cbar_limits:
                 uxda_fig.set_clim(vmin=cbar_limits[0], vmax=cbar_limits[1])
-            cbar = plt.colorbar(uxda_fig, cax=cbar_ax)
+            cbar = add_colorbar_to_map_template(template, cbar_x_offset)
             cbar.ax.tick_params(labelsize=cbar_label_size, length=0)
 
         # Add stippling to indicate regions of potential statistical significance (this is very slow, so not really practical at the moment). 
@@ -343,24 +437,22 @@ def plot_spatial_data_eam(inputs, grid_file):
                 # lat/lon coordinate, the stippling will indicate regions where the p-value is less than the designated threshold.
                 mask = da_pvalues <= p_value_threshold
                 #print(mask)
-                ax.contourf(da_pvalues.lon, da_pvalues.lat, mask, levels=1, hatches=['', stippling_hatches], 
-                            alpha=0, transform=ccrs.PlateCarree())
+                template['map_artists'].append(ax.contourf(da_pvalues.lon, da_pvalues.lat, mask, levels=1, hatches=['', stippling_hatches], 
+                                                           alpha=0, transform=ccrs.PlateCarree()))
             else:
                 # For all other cases, the stippling will indicate regions where the value is +/- some multiple of the standard deviation 
                 # (default is 2*std) away from the mean.
                 mask = np.abs(uxda) >= mean + stippling_std_multiple*std
                 #print(uxds)
-                ax.contourf(uxds['lon'], uxds['lat'], mask, levels=1, hatches=['', stippling_hatches], alpha=0, transform=ccrs.PlateCarree())
+                template['map_artists'].append(ax.contourf(uxds['lon'], uxds['lat'], mask, levels=1, hatches=['', stippling_hatches], alpha=0, 
+                                                           transform=ccrs.PlateCarree()))
         
         # Display statistics.
-        ax.text(x=0.88, y=0.9, s=f'Max:{max:.2e}\nMean:{mean:.2e}\nMedian:{median:.2e}\nMin:{min:.2e}', ha='left', 
-                fontsize=statistics_panel_size, transform=ax.transAxes)
-        ax.text(x=0.88, y=0.05, s=f'Std:{std:.2e}', ha='left', fontsize=statistics_panel_size, transform=ax.transAxes)
+        template['map_artists'].append(ax.text(x=0.88, y=0.9, s=f'Max:{max:.2e}\nMean:{mean:.2e}\nMedian:{median:.2e}\nMin:{min:.2e}', ha='left', 
+                                               fontsize=statistics_panel_size, transform=ax.transAxes))
+        template['map_artists'].append(ax.text(x=0.88, y=0.05, s=f'Std:{std:.2e}', ha='left', fontsize=statistics_panel_size, transform=ax.transAxes))
 
-        # Add additional features like coastline and oceans.
-        ax.coastlines(lw=0.6)
-
-        # Save the figure and then close it. Record the elapsed time.
+        # Save the figure and then clear the artists of this map from the template, so that the template can be reused. Record the elapsed time.
         end_time = time.time()
         elapsed_time = end_time - start_time
         if len(uxDataArrays_to_plot) > 1:
@@ -370,7 +462,7 @@ def plot_spatial_data_eam(inputs, grid_file):
         else:
             save_figure(plot_name, fig, inputs)
             print(f"Elapsed time for producing plots for {variable} in {plot_directory}: {elapsed_time:.2f} seconds") 
-        plt.close(fig)
+        clear_map_template(template)
 
 def plot_spatial_data_elm(inputs):
     """ 
@@ -443,10 +535,8 @@ def plot_spatial_data_elm(inputs):
     for file_set_index in range(num_file_sets):
         for file_index in range(num_files_in_each_set):
             file = netcdf_files[file_index][file_set_index]
-            if time_calculation == 'mean':
-                da = xr.open_dataset(file).sel(year=slice(start_year, end_year)).mean(dim='year')[variable]*multiplier
-            elif time_calculation == 'sum':
-                da = xr.open_dataset(file).sel(year=slice(start_year, end_year)).sum(dim='year')[variable]*multiplier
+            da = get_time_reduction_of_variable(inputs, file)[variable]*multiplier
+            if time_calculation == 'sum':
                 # If calculating the sum, change the per-time quantities and their units accordingly.
                 per_time_labels = ['/year', '/month', '/day', '/hour', '/min', '/s']
                 time_multipliers = np.array([1, years_TO_months, years_TO_days, years_TO_hours, years_TO_mins, years_TO_s])
@@ -485,7 +575,7 @@ def plot_spatial_data_elm(inputs):
         # we can compare the two data sets by performing a t-test at each individual lat/lon coordinate and later adding stippling.
         if num_files_in_each_set >= 2 and stippling_on and plot_type != 'separate_plots':
             # Perform this per-pixel t-test only if we do not want separate plots and if stippling_on is True (want to add p-value markers on plot).
-            da_pvalues = df.apply(perform_ttest, columns_set_1=columns_control_set, columns_set_2=columns_test_set, axis=1).fillna(1).to_xarray()
+            da_pvalues = calculate_p_values_for_dataframe_rows(df, columns_control_set, columns_test_set).fillna(1).to_xarray()
 
         # Perform a t-test to compare the two spatial data sets as whole over all coordinates. Print the results to the console and to an output file.
         ttest = stats.ttest_ind(df_control_set, df_test_set)
@@ -528,16 +618,23 @@ def plot_spatial_data_elm(inputs):
         if plot_type == 'percent_difference' and not cbar_limits and max > 100:
             cbar_limits = [-100, 100]
 
-        # Plot the DataArray and optionally add the title and colorbar.
-        fig = plt.figure(figsize=(width, height))
-        ax = fig.add_axes([0.1, 0.1, 0.8, 0.8], projection=projection())
-        da_fig = da.plot(ax=ax, transform=ccrs.PlateCarree(), cmap=plt.get_cmap(cmap_color), extend='both', add_colorbar=False)
+        # Plot the DataArray on the map template for this layout and lat/lon grid, which is built only once per process. The first map drawn with 
+        # the template creates the mesh and colorbar, while the following maps only update the data and color limits of the mesh.
+        grid_key = tuple((dim, da[dim].values.tobytes()) for dim in da.dims)
+        template = get_map_template(projection, width, height, key=(grid_key, cbar_on, cbar_x_offset))
+        fig, ax = template['fig'], template['ax']
+        if template['data_artist'] is None:
+            template['data_artist'] = da.plot(ax=ax, transform=ccrs.PlateCarree(), cmap=plt.get_cmap(cmap_color), extend='both', add_colorbar=False)
+        else:
+            template['data_artist'].set_array(da.values)
+            template['data_artist'].set_cmap(plt.get_cmap(cmap_color))
+            template['data_artist'].set_clim(*get_default_color_limits(da.values))
+        da_fig = template['data_artist']
         if title:
             plt.rcParams['axes.titlesize'] = title_size
             ax.set_title(title)
         if cbar_on:
-            cbar_ax = fig.add_axes([ax.get_position().x1+cbar_x_offset, ax.get_position().y0, 0.02, ax.get_position().height])
-            cbar = plt.colorbar(da_fig, cax=cbar_ax)
+            cbar = add_colorbar_to_map_template(template, cbar_x_offset)
             cbar.ax.tick_params(labelsize=cbar_label_size, length=0)
             if cbar_limits:
                 cbar.mappable.set_clim(cbar_limits[0], cbar_limits[1])
@@ -550,22 +647,21 @@ def plot_spatial_data_elm(inputs):
                 # If there are two data sets and at least two files in each data set so that we will have previously calculated p-values at each
                 # lat/lon coordinate, the stippling will indicate regions where the p-value is less than the designated threshold.
                 mask = da_pvalues <= p_value_threshold
-                ax.contourf(da_pvalues.lon, da_pvalues.lat, mask, levels=1, hatches=['', stippling_hatches], alpha=0, transform=ccrs.PlateCarree())
+                template['map_artists'].append(ax.contourf(da_pvalues.lon, da_pvalues.lat, mask, levels=1, hatches=['', stippling_hatches], alpha=0, 
+                                                           transform=ccrs.PlateCarree()))
             else:
                 # For all other cases, the stippling will indicate regions where the value is +/- some multiple of the standard deviation 
                 # (default is 2*std) away from the mean.
                 mask = np.abs(da) >= mean + stippling_std_multiple*std
-                ax.contourf(da.lon, da.lat, mask, levels=1, hatches=['', stippling_hatches], alpha=0, transform=ccrs.PlateCarree())
+                template['map_artists'].append(ax.contourf(da.lon, da.lat, mask, levels=1, hatches=['', stippling_hatches], alpha=0, 
+                                                           transform=ccrs.PlateCarree()))
         
         # Display statistics.
-        ax.text(x=0.88, y=0.9, s=f'Max:{max:.2e}\nMean:{mean:.2e}\nMedian:{median:.2e}\nMin:{min:.2e}', ha='left', 
-                fontsize=statistics_panel_size, transform=ax.transAxes)
-        ax.text(x=0.88, y=0.05, s=f'Std:{std:.2e}', ha='left', fontsize=statistics_panel_size, transform=ax.transAxes)
+        template['map_artists'].append(ax.text(x=0.88, y=0.9, s=f'Max:{max:.2e}\nMean:{mean:.2e}\nMedian:{median:.2e}\nMin:{min:.2e}', ha='left', 
+                                               fontsize=statistics_panel_size, transform=ax.transAxes))
+        template['map_artists'].append(ax.text(x=0.88, y=0.05, s=f'Std:{std:.2e}', ha='left', fontsize=statistics_panel_size, transform=ax.transAxes))
 
-        # Add additional features like coastline and oceans.
-        ax.coastlines(lw=0.6)
-
-        # Save the figure and then close it. Record the elapsed time.
+        # Save the figure and then clear the artists of this map from the template, so that the template can be reused. Record the elapsed time.
         end_time = time.time()
         elapsed_time = end_time - start_time
         if len(dataArrays_to_plot) > 1:
@@ -575,7 +671,7 @@ def plot_spatial_data_elm(inputs):
         else:
             save_figure(plot_name, fig, inputs)
             print(f"Elapsed time for producing plots for {variable} in {plot_directory}: {elapsed_time:.2f} seconds") 
-        plt.close(fig)
+        clear_map_template(template)
 
 def plot_spatial_data_from_netcdf_files(inputs):
     """ 
@@ -598,16 +694,18 @@ def plot_spatial_data_from_netcdf_files(inputs):
 ###---------------Begin execution---------------###
 if __name__ == '__main__':
 
-    # Run this script together with the input JSON file(s) on the command line.
+    # Run this script together with the input JSON file(s) on the command line. By default, each NetCDF file is read only once for all the 
+    # variables plotted from it; with --load-per-variable, each plotting task instead reads the files for its own variable.
     start_time = time.time()
-    if len(sys.argv) < 2:
-        print('Usage: python e3sm_plot_spatial_data.py `path/to/json/input/file(s)\'')
+    input_files, options = parse_command_line_arguments(sys.argv[1:])
+    if len(input_files) < 1:
+        print('Usage: python e3sm_plot_spatial_data.py `path/to/json/input/file(s)\' [--load-per-variable]')
         sys.exit()
+    load_per_variable = options.get('load_per_variable', False)
 
     # Read and load the JSON file(s) into a list of dictionaries.
     inputs = []
-    for index in range(1, len(sys.argv)):
-        input_file = sys.argv[index]
+    for input_file in input_files:
         with open(input_file) as f:
             inputs.extend(json.load(f))
     
@@ -624,8 +722,15 @@ if __name__ == '__main__':
         if os.path.exists(file): 
             os.remove(file)
 
-    # Create all of the spatial plots in parallel.
-    with multiprocessing.Pool(processes=MAX_PROCESSES) as pool:
+    # Create all of the spatial plots in parallel. If the files have already been read for all variables at once, the plotting tasks only work 
+    # on the small time reductions. Otherwise, the number of processes is sized by the memory needed to read the NetCDF files of each plot.
+    if load_per_variable:
+        memory_per_task = max(sum(estimate_memory_of_netcdf_variables(file, [inputs['variable']]) for files in inputs['netcdf_files'] for file in files) 
+                              for inputs in list_of_inputs)
+    else:
+        load_time_reductions_for_plots(list_of_inputs)
+        memory_per_task = None
+    with create_process_pool(num_tasks=len(list_of_inputs), memory_per_task=memory_per_task) as pool:
         pool.map(plot_spatial_data_from_netcdf_files, list_of_inputs)
     
     # Sort all the p-value files alphabetically.
@@ -1,7 +1,8 @@
-import multiprocessing
 import numpy as np
 import time
 import xarray as xr
+from utility_e3sm_netcdf import estimate_memory_of_netcdf_variables, get_netcdf_encoding
+from utility_functions import create_process_pool
 
 def produce_synthetic_spatial_data(inputs):
     """ 
@@ -25,7 +26,7 @@ def produce_synthetic_spatial_data(inputs):
         for variable in variables:   
             ds[variable] *= random_multipliers[index]
         new_file = file.replace('.nc', f'_{index+2}.nc')
-        ds.to_netcdf(new_file, mode='w')
+        ds.to_netcdf(new_file, mode='w', encoding=get_netcdf_encoding(ds))
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Elapsed time for producing the synthetic spatial data for {file}: {elapsed_time:.2f} seconds")
@@ -45,8 +46,9 @@ if __name__ == '__main__':
     num_files_in_each_set = [5]*len(files)
     inputs = list(zip(files, num_files_in_each_set))
 
-    # Produce each set in parallel.
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
+    # Produce each set in parallel, with the number of processes sized by the memory needed to read all variables of each file.
+    memory_per_task = max(estimate_memory_of_netcdf_variables(file, None) for file in files)
+    with create_process_pool(num_tasks=len(inputs), memory_per_task=memory_per_task) as pool:
         pool.map(produce_synthetic_spatial_data, inputs)
     
     # Print the total execution time needed to produce all the sets.
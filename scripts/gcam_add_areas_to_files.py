@@ -1,66 +1,43 @@
-import itertools
 import json
-import multiprocessing
 import pandas as pd
 import sys
 import time
 from utility_constants import *
-from utility_dataframes import read_file_into_dataframe, write_dataframe_to_file
+from utility_file_formats import read_data_file_into_dataframe, write_dataframe_to_data_file
 from utility_gcam import modify_crop_names
 
-def add_areas_to_subset_of_file(df, df_land, geographical_label, category_label, scenario, geography, category):
+def add_areas_to_dataframe(df, df_land, geographical_label, category_label):
     """ 
     Adds areas from land allocation data contained in a Pandas DataFrame to another DataFrame containing data for the quantity of interest.
-    This function adds areas to a subset of the DataFrame that matches the given scenario, geographical unit, and category.
+    The areas of all scenarios, geographical units, categories, and years are matched at once with a single merge on these keys.
 
     Parameters:
         df: DataFrame containing the data of interest.
         df_land: DataFrame for the land allocation areas.
         geographical_label: String specifying the label for the geographical unit (e.g., 'region' or 'basin').
-        category_label: String specifying the label for the appropriate category (e.g., 'sector' or 'landtype').
-        scenario: String for the scenario (simulation name) of interest.
-        geography: String specifying the name of the geographical unit for the subset of interest (e.g., the name of the region or the basin).
-        category: String specifying the name of the category for the subset of interest (e.g., the name of the sector or the landtype).
+        category_label: String specifying the label for the appropriate category (e.g., 'sector' or 'landtype'), which is matched with the landtype 
+                        of the land allocations. If None, the areas of all landtypes are added up.
 
     Returns:
         DataFrame that is the same as the input df, but with an extra column for the corresponding land allocation areas.
     """
-    # Read in two DataFrames: one for the data and the other land allocations, get the appropriate subset for each of them, 
-    # and put these two subset DataFrames into a list that we will then work with below.
-    dataframes = [df, df_land]
-    columns = {0: ['scenario', geographical_label, category_label], 1: ['scenario', geographical_label, 'landtype']}
-    matches = [scenario, geography, category]
-    for df_index, dataframe in enumerate(dataframes):
-        for index, column in enumerate(columns[df_index]):
-            dataframe = dataframe[dataframe[column] == matches[index]]
-        dataframes[df_index] = dataframe
-
-    df = dataframes[0]
-    start_year, end_year = min(df['year'].unique()), max(df['year'].unique())
-    df_land = dataframes[1]
-    if df_land.empty:
-        # If there are no corresponding land allocations, set the areas to 0.
-        df['area'] = 0
-    else:
-        df_land = df_land[(df_land['year'] >= start_year) & (df_land['year'] <= end_year)]
-        if geographical_label == 'region':
-            # For each year, add up the areas of all rows (e.g., from all basins) that correspond to the given scenario, category, and region.
-            df['area'] = df_land.groupby('year').sum()['value'].to_numpy()
-        if geographical_label == 'basin':
-            # If matching on the basin, there could be multiple regions that contain parts of this basin. As a result, for each year, 
-            # collect the areas of all matching regions that correspond to the given scenario, category, and basin.
-            regions = df['region'].unique()
-            dataframes_for_this_region = []
-            for region in regions:
-                df_this_region = df[df['region'] == region].copy()
-                df_land_this_region = df_land[df_land['region'] == region]
-                if df_land_this_region.empty:
-                    df_this_region['area'] = 0
-                else:
-                    df_this_region['area'] = df_land_this_region['value'].to_numpy()
-                dataframes_for_this_region.append(df_this_region)
-            # Concatenate the DataFrame from all regions into a single DataFrame for the given scenario, category, and basin.
-            df = pd.concat(dataframes_for_this_region)
+    # Match the data and the land allocations on the scenario, geographical unit, category, and year. If matching on the basin, there could be 
+    # multiple regions that contain parts of this basin, so the region is matched as well to get the area of the part of the basin in each region.
+    # If matching on the region, the areas of all rows (e.g., from all basins) that correspond to the same keys are added up.
+    keys = ['scenario', geographical_label]
+    if geographical_label == 'basin':
+        keys.append('region')
+    land_keys = keys + ['year']
+    data_keys = keys + ['year']
+    if category_label:
+        land_keys.insert(-1, 'landtype')
+        data_keys.insert(-1, category_label)
+    df_land = df_land.groupby(land_keys, as_index=False)['value'].sum()
+    df_land.columns = data_keys + ['area']
+
+    # Keep the rows and the index of the data as they are. If there are no corresponding land allocations, set the areas to 0.
+    df = df.copy()
+    df['area'] = df[data_keys].merge(df_land, on=data_keys, how='left')['area'].fillna(0).to_numpy()
     return df
 
 def add_areas_to_file(inputs):
@@ -81,34 +58,20 @@ def add_areas_to_file(inputs):
     geographical_label = inputs['geographical_label']
     category_label = inputs.get('category_label', None)
     land_allocation_file = inputs['land_allocation_file']
-    df = read_file_into_dataframe(input_file)
-    df_land = read_file_into_dataframe(land_allocation_file)
+    df = read_data_file_into_dataframe(input_file)
+    df_land = read_data_file_into_dataframe(land_allocation_file)
     mean_or_sum_if_more_than_one_row_in_same_landtype_group = inputs.get('mean_or_sum_if_more_than_one_row_in_same_landtype_group', None) 
     call_modify_crop_names = inputs.get('call_modify_crop_names', False)
     
-    # Form a list of tuples that represents the Cartesian product of all scenarios, geographies, and categories, along with the DataFrames and labels.
-    scenarios = df['scenario'].unique()
-    geographies = df[geographical_label].unique()
-    if category_label:
-        categories = df[category_label].unique()
-    else:
-        categories = [None]
-    cartesian_product = list(itertools.product([df], [df_land], [geographical_label], [category_label], 
-                                               scenarios, geographies, categories))
-
-    # Add areas for each subset of the data (each tuple in the Cartesian product) in parallel. Store the subsets in a list of DataFrames.
-    with multiprocessing.Pool(processes=MAX_PROCESSES) as pool:
-        dataframes_for_each_subset = list(pool.starmap(add_areas_to_subset_of_file, cartesian_product))
-
-    # Concatenate all DataFrames in the list together to form a single DataFrame for this file. Sort by all the given key columns.
-    df = pd.concat(dataframes_for_each_subset)
+    # Add the areas for all scenarios, geographies, and categories in a single vectorized merge. Sort by all the given key columns.
+    df = add_areas_to_dataframe(df, df_land, geographical_label, category_label)
     df.sort_values(key_columns, inplace=True)
 
     # Update original crop names to a common, standardized set of names. 
     if call_modify_crop_names:
         df = modify_crop_names(df, key_columns, mean_or_sum_if_more_than_one_row_in_same_landtype_group)
 
-    write_dataframe_to_file(df, output_file)
+    write_dataframe_to_data_file(df, output_file)
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Elapsed time for adding areas to {output_file}: {elapsed_time:.2f} seconds")
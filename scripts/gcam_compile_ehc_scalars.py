@@ -1,11 +1,9 @@
 import json
-import multiprocessing
 import pandas as pd
 import sys
 import time
-from utility_constants import MAX_PROCESSES
-from utility_dataframes import read_file_into_dataframe, write_dataframe_to_file
-from utility_functions import get_all_files_in_path
+from utility_file_formats import read_data_file_into_dataframe, write_dataframe_to_data_file
+from utility_functions import create_process_pool, get_all_files_in_path
 from utility_gcam import modify_crop_names
 
 def compile_ehc_scalars(inputs):
@@ -29,7 +27,7 @@ def compile_ehc_scalars(inputs):
     for index, scenario in enumerate(scenarios):
         input_directory = input_directories[index]
         files = get_all_files_in_path(input_directory)
-        dataframes_for_all_files_for_this_scenario = [read_file_into_dataframe(file) for file in files]
+        dataframes_for_all_files_for_this_scenario = [read_data_file_into_dataframe(file) for file in files]
         df = pd.concat(dataframes_for_all_files_for_this_scenario, ignore_index=True)
         # Convert all column names to lowercase.
         df.columns = df.columns.str.lower()
@@ -49,7 +47,7 @@ def compile_ehc_scalars(inputs):
     if call_modify_crop_names:
         df = modify_crop_names(df, key_columns)
 
-    write_dataframe_to_file(df, output_file)
+    write_dataframe_to_data_file(df, output_file)
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Elapsed time processing/compiling the data for {output_file}: {elapsed_time:.2f} seconds")
@@ -72,7 +70,7 @@ if __name__ == '__main__':
             list_of_inputs.extend(json.load(f))
 
     # Produce data for each file in parallel.
-    with multiprocessing.Pool(processes=MAX_PROCESSES) as pool:
+    with create_process_pool(num_tasks=len(list_of_inputs)) as pool:
         pool.map(compile_ehc_scalars, list_of_inputs)
     
     # Print the total execution time needed to process/compile the scalars for all files.
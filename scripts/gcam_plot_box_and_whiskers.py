@@ -1,16 +1,15 @@
 import itertools
 import json
 from matplotlib import pyplot as plt
-import multiprocessing
 import os
 import pandas as pd
 import seaborn as sns
 import sys
 import time
 from utility_constants import *
-from utility_dataframes import read_file_into_dataframe
-from utility_functions import check_is_list_of_lists, transpose_scenarios_if_needed
-from utility_gcam import gcam_landtype_groups, gcam_landtype_groups_original, produce_dataframe_for_landtype_group
+from utility_file_formats import read_data_file_into_dataframe_with_cache
+from utility_functions import check_is_list_of_lists, create_process_pool, estimate_memory_of_files, transpose_scenarios_if_needed
+from utility_gcam import gcam_landtype_groups, gcam_landtype_groups_original, produce_dataframe_for_landtype_groups
 from utility_plots import *
 
 """ Dictionary of default input values for box plots (i.e., box-and-whisker plots). """
@@ -69,7 +68,7 @@ def process_inputs(inputs):
         Dictionary that completely specifies all plotting options. 
         If the user did not make a choice for a particular option, the default choice for that plotting option will be selected.
     """
-    df = read_file_into_dataframe(inputs['output_file'])
+    df = read_data_file_into_dataframe_with_cache(inputs['output_file'])
 
     # If the category label (e.g., sector or landtype) has not been specified, use the default value.
     if 'category_label' not in inputs:
@@ -100,11 +99,11 @@ def process_inputs(inputs):
 
     # Use the name of the output file itself (without its path) to set defaults for the y-axis label and the name of the plot.
     index_of_last_backslash = inputs['output_file'].rfind('/')
-    index_of_dot_csv = inputs['output_file'].find('.csv')
+    index_of_extension = inputs['output_file'].rfind('.')
     if index_of_last_backslash == -1:
-        output_file_name = inputs['output_file'][:index_of_dot_csv]
+        output_file_name = inputs['output_file'][:index_of_extension]
     else:
-        output_file_name = inputs['output_file'][index_of_last_backslash+1:index_of_dot_csv]
+        output_file_name = inputs['output_file'][index_of_last_backslash+1:index_of_extension]
     if 'y_label' not in inputs:
         inputs['y_label'] = output_file_name
     if 'plot_name' not in inputs:
@@ -217,7 +216,7 @@ def plot_box_and_whiskers(inputs):
     setup_plot_params(plot_options)
 
     # Read the file, select rows between the start and end years, apply user-specified multiplier, create the figure and axis objects for the plot.
-    df = read_file_into_dataframe(output_file)
+    df = read_data_file_into_dataframe_with_cache(output_file)
     df = df[(df[year_label] >= start_year) & (df[year_label] <= end_year)]
     df[value_label] *= multiplier
     fig, ax = plt.subplots(nrows=1, ncols=1)
@@ -283,13 +282,14 @@ def plot_box_and_whiskers(inputs):
         df_all[category_label] = 'All'
         dataframes.append(df_all) 
         categories.remove('All')
-    if any(item in landtype_groups for item in categories):
-        for landtype_group in landtype_groups:
-            if landtype_group in categories:
-                df_this_landtype_group = produce_dataframe_for_landtype_group(df, landtype_group, category_label, 
-                    value_label, landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns)
-                dataframes.append(df_this_landtype_group)
-                categories.remove(landtype_group)
+    landtype_groups_in_categories = [landtype_group for landtype_group in landtype_groups if landtype_group in categories]
+    if landtype_groups_in_categories:
+        # Aggregate all of the landtype groups at once.
+        df_landtype_groups = produce_dataframe_for_landtype_groups(df, landtype_groups_in_categories, category_label, 
+            value_label, landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns)
+        dataframes.append(df_landtype_groups)
+        for landtype_group in landtype_groups_in_categories:
+            categories.remove(landtype_group)
     if categories:
         df = df[df[category_label].isin(categories)]
         dataframes.append(df)
@@ -356,8 +356,9 @@ if __name__ == '__main__':
     for index in range(len(inputs)):
         list_of_inputs.append(process_inputs(inputs[index]))
 
-    # Create all of the box plots in parallel.
-    with multiprocessing.Pool(processes=MAX_PROCESSES) as pool:
+    # Create all of the box plots in parallel, with the number of processes sized by the memory needed to read each data file.
+    memory_per_task = max(estimate_memory_of_files([inputs['output_file']]) for inputs in list_of_inputs)
+    with create_process_pool(num_tasks=len(list_of_inputs), memory_per_task=memory_per_task) as pool:
         pool.map(plot_box_and_whiskers, list_of_inputs)
     
     # Print the total execution time to produce all the plots.
@@ -1,17 +1,17 @@
 import geopandas as gpd
 import json
 from matplotlib import pyplot as plt
-import multiprocessing
 import os
 import pandas as pd
 from scipy import stats
 import sys
 import time
 from utility_constants import *
-from utility_dataframes import perform_ttest, read_file_into_dataframe
-from utility_functions import check_is_list_of_lists, print_p_values, sort_file, transpose_scenarios_if_needed
+from utility_file_formats import read_data_file_into_dataframe_with_cache
+from utility_functions import check_is_list_of_lists, create_process_pool, estimate_memory_of_files, print_p_values, sort_file, transpose_scenarios_if_needed
 from utility_gcam import *
 from utility_plots import *
+from utility_statistics import calculate_p_values_for_dataframe_rows
 
 """ Dictionary of default input values for spatial plots. """
 default_inputs = {
@@ -64,7 +64,7 @@ def process_inputs(inputs):
         Dictionary that completely specifies all plotting options. 
         If the user did not select a plotting option fora particular category, the default choice for that plotting option will be selected.
     """
-    df = read_file_into_dataframe(inputs['output_file'])
+    df = read_data_file_into_dataframe_with_cache(inputs['output_file'])
 
     # If the category label (e.g., sector or landtype) has not been specified, use the default value.
     if 'category_label' not in inputs:
@@ -97,11 +97,11 @@ def process_inputs(inputs):
 
     # Use the name of the output file itself (without its path) to set defaults for the title and the name of the plot.
     index_of_last_backslash = inputs['output_file'].rfind('/')
-    index_of_dot_csv = inputs['output_file'].find('.csv')
+    index_of_extension = inputs['output_file'].rfind('.')
     if index_of_last_backslash == -1:
-        output_file_name = inputs['output_file'][:index_of_dot_csv]
+        output_file_name = inputs['output_file'][:index_of_extension]
     else:
-        output_file_name = inputs['output_file'][index_of_last_backslash+1:index_of_dot_csv]
+        output_file_name = inputs['output_file'][index_of_last_backslash+1:index_of_extension]
     if 'title' not in inputs:
         inputs['title'] = output_file_name
     if 'plot_name' not in inputs:
@@ -201,7 +201,7 @@ def plot_spatial_data(inputs):
     setup_plot_params(plot_options)
 
     # Read the data file into a Pandas DataFrame and select rows between the start and end years.
-    df = read_file_into_dataframe(output_file)
+    df = read_data_file_into_dataframe_with_cache(output_file)
     df = df[(df[year_label] >= start_year) & (df[year_label] <= end_year)]
     # Apply the multiplier to the value column (this could be used to change units, for example).
     df[value_label] *= multiplier
@@ -220,13 +220,14 @@ def plot_spatial_data(inputs):
         df_all[category_label] = 'All'
         dataframes.append(df_all) 
         categories.remove('All')
-    if any(item in landtype_groups for item in categories):
-        for landtype_group in landtype_groups:
-            if landtype_group in categories:
-                df_this_landtype_group = produce_dataframe_for_landtype_group(df, landtype_group, category_label, 
-                    value_label, landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns)
-                dataframes.append(df_this_landtype_group)
-                categories.remove(landtype_group)
+    landtype_groups_in_categories = [landtype_group for landtype_group in landtype_groups if landtype_group in categories]
+    if landtype_groups_in_categories:
+        # Aggregate all of the landtype groups at once.
+        df_landtype_groups = produce_dataframe_for_landtype_groups(df, landtype_groups_in_categories, category_label, 
+            value_label, landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns)
+        dataframes.append(df_landtype_groups)
+        for landtype_group in landtype_groups_in_categories:
+            categories.remove(landtype_group)
     if categories:
         df = df[df[category_label].isin(categories)]
         dataframes.append(df)
@@ -319,7 +320,7 @@ def plot_spatial_data(inputs):
                 # If there are two scenario sets, do a t-test at each individual region-and-basin combination and put results into the GeoDataFrame.
                 df = pd.DataFrame()
                 df[columns_control], df[columns_test] = gdf[columns_control], gdf[columns_test]
-                gdf['p_value'] = df.apply(perform_ttest, columns_set_1=columns_control, columns_set_2=columns_test, axis=1).fillna(1)
+                gdf['p_value'] = calculate_p_values_for_dataframe_rows(df, columns_control, columns_test).fillna(1)
         # Calculate either the absolute difference or percent difference between the means of the test and control data sets.
         control_data = gdf.loc[:, columns_control].mean(axis=1)
         test_data = gdf.loc[:, columns_test].mean(axis=1)
@@ -386,8 +387,9 @@ if __name__ == '__main__':
         if os.path.exists(file): 
             os.remove(file)
 
-    # Create all of the box plots in parallel.
-    with multiprocessing.Pool(processes=MAX_PROCESSES) as pool:
+    # Create all of the box plots in parallel, with the number of processes sized by the memory needed to read each data file.
+    memory_per_task = max(estimate_memory_of_files([inputs['output_file']]) for inputs in list_of_inputs)
+    with create_process_pool(num_tasks=len(list_of_inputs), memory_per_task=memory_per_task) as pool:
         pool.map(plot_spatial_data, list_of_inputs)
     
     # Sort all the p-value files alphabetically.
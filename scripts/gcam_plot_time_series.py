@@ -1,17 +1,17 @@
 import itertools
 import json
 from matplotlib import pyplot as plt
-import multiprocessing
 import os
 import pandas as pd
 from scipy import stats
 import sys
 import time
 from utility_constants import *
-from utility_dataframes import perform_ttest, read_file_into_dataframe
-from utility_functions import check_is_list_of_lists, print_p_values, sort_file, transpose_scenarios_if_needed
-from utility_gcam import gcam_landtype_groups, gcam_landtype_groups_original, produce_dataframe_for_landtype_group
+from utility_file_formats import read_data_file_into_dataframe_with_cache
+from utility_functions import check_is_list_of_lists, create_process_pool, estimate_memory_of_files, print_p_values, sort_file, transpose_scenarios_if_needed
+from utility_gcam import gcam_landtype_groups, gcam_landtype_groups_original, produce_dataframe_for_landtype_groups
 from utility_plots import *
+from utility_statistics import calculate_p_values_for_dataframe_rows
 
 """ Dictionary of default input values for time series plots. """
 default_inputs = {
@@ -77,7 +77,7 @@ def process_inputs(inputs):
         Dictionary that completely specifies all plotting options. 
         If the user did not make a choice for a particular option, the default choice for that plotting option will be selected.
     """
-    df = read_file_into_dataframe(inputs['output_file'])
+    df = read_data_file_into_dataframe_with_cache(inputs['output_file'])
 
     # If the category label (e.g., sector or landtype) has not been specified, use the default value.
     if 'category_label' not in inputs:
@@ -110,11 +110,11 @@ def process_inputs(inputs):
 
     # Use the name of the output file itself (without its path) to set defaults for the y-axis label and the name of the plot.
     index_of_last_backslash = inputs['output_file'].rfind('/')
-    index_of_dot_csv = inputs['output_file'].find('.csv')
+    index_of_extension = inputs['output_file'].rfind('.')
     if index_of_last_backslash == -1:
-        output_file_name = inputs['output_file'][:index_of_dot_csv]
+        output_file_name = inputs['output_file'][:index_of_extension]
     else:
-        output_file_name = inputs['output_file'][index_of_last_backslash+1:index_of_dot_csv]
+        output_file_name = inputs['output_file'][index_of_last_backslash+1:index_of_extension]
     if 'y_label' not in inputs:
         inputs['y_label'] = output_file_name
     if 'plot_name' not in inputs:
@@ -252,8 +252,9 @@ def plot_time_series(inputs):
     fig, ax = plt.subplots(nrows=1, ncols=1)
 
     # Read the output file into a DataFrame and filter it to only include data within the specified year range.
-    df = read_file_into_dataframe(output_file)
+    df = read_data_file_into_dataframe_with_cache(output_file)
     df = df[(df[year_label] >= start_year) & (df[year_label] <= end_year)]
+    landtype_groups_in_categories = [category for category in categories if category in landtype_groups]
 
     # Option 1: individual plots, in which each such time series plot includes one or more individual (not grouped) curves.
     if not check_is_list_of_lists(scenarios) or plot_type == 'individual':
@@ -270,6 +271,10 @@ def plot_time_series(inputs):
             scenario = scenarios[scenario_index]
             df_this_scenario = df[df[scenario_label] == scenario]
             num_categories = len(categories)
+            # Aggregate all of the categories that correspond to a group of landtypes at once for this scenario.
+            if landtype_groups_in_categories:
+                df_landtype_groups = produce_dataframe_for_landtype_groups(df_this_scenario, landtype_groups_in_categories, category_label, 
+                            value_label, landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns)
 
             for category_index, category in enumerate(categories):
 
@@ -278,8 +283,7 @@ def plot_time_series(inputs):
                 if category == 'All':
                     df_this_category = df_this_scenario
                 elif category in landtype_groups:
-                    df_this_category = produce_dataframe_for_landtype_group(df_this_scenario, category, category_label, 
-                                value_label, landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns)
+                    df_this_category = df_landtype_groups[df_landtype_groups[category_label] == category]
                 else:
                     df_this_category = df_this_scenario[df_this_scenario[category_label] == category]
                     
@@ -420,6 +424,10 @@ def plot_time_series(inputs):
             for scenario_index, scenario in enumerate(scenarios_in_set):
                 scenario = scenarios_in_set[scenario_index]
                 df_this_scenario = df[df[scenario_label] == scenario]
+                # Aggregate all of the categories that correspond to a group of landtypes at once for this scenario.
+                if landtype_groups_in_categories:
+                    df_landtype_groups = produce_dataframe_for_landtype_groups(df_this_scenario, landtype_groups_in_categories, category_label, 
+                                value_label, landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns)
 
                 for category_index, category in enumerate(categories):
                     # One of three choices to consider: 1) all categories (no further winnowing down of the DataFrame), 2) a category that 
@@ -427,8 +435,7 @@ def plot_time_series(inputs):
                     if category == 'All':
                         df_this_category = df_this_scenario
                     elif category in landtype_groups:
-                        df_this_category = produce_dataframe_for_landtype_group(df_this_scenario, category, category_label, 
-                                value_label, landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns)
+                        df_this_category = df_landtype_groups[df_landtype_groups[category_label] == category]
                     else:
                         df_this_category = df_this_scenario[df_this_scenario[category_label] == category]
 
@@ -561,8 +568,7 @@ def plot_time_series(inputs):
                                         (f'set=0' in column and f'cat={category_index}_reg={region_index}' in column)]
                         columns_this_set = [column for column in df_all_time_series.columns if 
                                         (f'set={scenario_set_index}' in column and f'cat={category_index}_reg={region_index}' in column)]
-                        p_values = df_all_time_series.apply(perform_ttest, columns_set_1=columns_control_set, \
-                                                               columns_set_2=columns_this_set, axis=1).fillna(1)
+                        p_values = calculate_p_values_for_dataframe_rows(df_all_time_series, columns_control_set, columns_this_set).fillna(1)
                         # If the p-value is below the threshold, add a marker to the plot at that time period (year).
                         mask = p_values <= p_value_threshold
                         ax.plot(df_all_time_series['Year'][mask], y_series[mask], color=line_color, linestyle='None', linewidth=linewidth, \
@@ -630,8 +636,9 @@ if __name__ == '__main__':
         if os.path.exists(file): 
             os.remove(file)
 
-    # Create all of the times series plots in parallel.
-    with multiprocessing.Pool(processes=MAX_PROCESSES) as pool:
+    # Create all of the times series plots in parallel, with the number of processes sized by the memory needed to read each data file.
+    memory_per_task = max(estimate_memory_of_files([inputs['output_file']]) for inputs in list_of_inputs)
+    with create_process_pool(num_tasks=len(list_of_inputs), memory_per_task=memory_per_task) as pool:
         pool.map(plot_time_series, list_of_inputs)
 
     # Sort all the p-value files alphabetically.
@@ -1,10 +1,9 @@
 import json
-import multiprocessing
 import pandas as pd
 import sys
 import time
-from utility_constants import MAX_PROCESSES
-from utility_dataframes import read_file_into_dataframe, write_dataframe_to_file
+from utility_file_formats import read_data_file_into_dataframe, write_dataframe_to_data_file
+from utility_functions import create_process_pool, estimate_memory_of_files
 from utility_gcam import modify_crop_names
 
 def process_extracted_data(inputs):
@@ -27,7 +26,7 @@ def process_extracted_data(inputs):
     mean_or_sum_if_more_than_one_row_in_same_landtype_group = inputs.get('mean_or_sum_if_more_than_one_row_in_same_landtype_group', None) 
     call_modify_crop_names = inputs.get('call_modify_crop_names', False)
     
-    df = read_file_into_dataframe(input_file)
+    df = read_data_file_into_dataframe(input_file)
     if columns_to_drop:
         df = df.drop(columns_to_drop, axis=1)
     df.columns = df.columns.str.lower()
@@ -53,7 +52,7 @@ def process_extracted_data(inputs):
     if call_modify_crop_names:
         df = modify_crop_names(df, key_columns, mean_or_sum_if_more_than_one_row_in_same_landtype_group)
 
-    write_dataframe_to_file(df, output_file)
+    write_dataframe_to_data_file(df, output_file)
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Elapsed time for producing {output_file}: {elapsed_time:.2f} seconds")
@@ -75,8 +74,9 @@ if __name__ == '__main__':
         with open(input_file) as f:
             list_of_inputs.extend(json.load(f))
 
-    # Produce data for each file in parallel.
-    with multiprocessing.Pool(processes=MAX_PROCESSES) as pool:
+    # Produce data for each file in parallel, with the number of processes sized by the memory needed to read each input file.
+    memory_per_task = max(estimate_memory_of_files([inputs['input_file']]) for inputs in list_of_inputs)
+    with create_process_pool(num_tasks=len(list_of_inputs), memory_per_task=memory_per_task) as pool:
         pool.map(process_extracted_data, list_of_inputs)
     
     # Print the total execution time needed to process/compile the scalars for all files.
@@ -1,9 +1,8 @@
-import multiprocessing
 import numpy as np
 import pandas as pd
 import time
-from utility_constants import MAX_PROCESSES
 from utility_dataframes import read_file_into_dataframe, write_dataframe_to_fwf
+from utility_functions import create_process_pool, estimate_memory_of_files
 
 def produce_synthetic_time_series(inputs):
     """ 
@@ -79,8 +78,9 @@ if __name__ == '__main__':
     num_variations_for_each_scenario = [5]*len(files)
     inputs = list(zip(files, all_scenarios, scenario_labels, columns_to_modify, num_variations_for_each_scenario))
 
-    # Produce data for each file in parallel.
-    with multiprocessing.Pool(processes=MAX_PROCESSES) as pool:
+    # Produce data for each file in parallel, with the number of processes sized by the memory needed to read each file.
+    memory_per_task = max(estimate_memory_of_files([file]) for file in files)
+    with create_process_pool(num_tasks=len(inputs), memory_per_task=memory_per_task) as pool:
         pool.map(produce_synthetic_time_series, inputs)
     
     # Print the total execution time needed to produce all the sets.
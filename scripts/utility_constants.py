@@ -1,6 +1,7 @@
 import math
 import multiprocessing
 import numpy as np
+import os
 
 """ Unit conversion factors. """
 km_TO_m = 1e3
@@ -47,4 +48,33 @@ MONTH_NUM_TO_NAME = {1: 'January', 2: 'February', 3: 'March', 4: 'April', 5: 'Ma
                      7: 'July', 8: 'August', 9: 'September', 10: 'October', 11: 'November', 12: 'December'}
 
 """ Limit the number of processes to reduce memory pressure - use at most 16 cores or half of the available ones. """ 
-MAX_PROCESSES = min(16, math.ceil(multiprocessing.cpu_count() / 2))
\ No newline at end of file
+MAX_PROCESSES = min(16, math.ceil(multiprocessing.cpu_count() / 2))
+
+""" Maximum number of processes when the memory of each task has been estimated (see get_number_of_processes() in utility_functions.py), since the 
+estimates are rough. It can be set with the E3SM_GCAM_MAX_PROCESSES environment variable (e.g., to the number of cores of a Slurm job allocation). """
+MAX_PROCESSES_WITH_MEMORY_ESTIMATE = int(os.environ.get('E3SM_GCAM_MAX_PROCESSES', min(32, multiprocessing.cpu_count())))
+
+""" Default directory for the catalogs of files in simulation directories (see update_file_catalog() in utility_e3sm_netcdf.py). """
+FILE_CATALOG_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'e3sm_gcam_analysis')
+
+""" Fraction of the available memory that worker processes are allowed to use (see create_process_pool() in utility_functions.py). """
+MEMORY_SAFETY_FRACTION = 0.8
+
+""" Rough ratio between the peak memory of a task and the size of the data it reads, to account for Pandas DataFrames and intermediate copies. """
+MEMORY_OVERHEAD_FACTOR = 4
+
+""" File extensions of the binary columnar formats for DataFrames (see utility_file_formats.py). These require the pyarrow package. """
+COLUMNAR_FILE_EXTENSIONS = ('.parquet', '.feather')
+
+""" Suffix of the Parquet sidecar files that cache parsed csv and fixed-width-format files (see read_data_file_into_dataframe_with_cache() in utility_file_formats.py). """
+PARSED_FILE_CACHE_SUFFIX = '.parsed.parquet'
+
+""" Executors that can run the tasks of the extract scripts (see imap_unordered_with_executor() in utility_functions.py). The first one is the default. """
+EXECUTORS = ('multiprocessing', 'mpi', 'dask')
+
+""" Default zlib compression level (0 to 9, where 0 means no compression) of the NetCDF files written by the E3SM scripts (see get_netcdf_encoding() in utility_e3sm_netcdf.py). """
+NETCDF_COMPRESSION_LEVEL = 4
+
+""" Aggregate groups of the 17 natural plant functional types (PFTs) in E3SM land data, as (first, last) PFT indices: 1 bare, 8 tree, 3 shrub, 
+3 grass, 1 crop, 1 empty (ignored). """
+PFT_GROUPS = {'BARE': (0, 0), 'FOREST': (1, 8), 'SHRUB': (9, 11), 'GRASS': (12, 14), 'CROP': (15, 15)}
@@ -1,6 +1,96 @@
+import hashlib
+import netCDF4
+import os
+import re
+from scipy import sparse
+import sqlite3
 import xarray as xr
 from utility_constants import *
-from utility_functions import create_numpy_array_from_ds
+from utility_functions import check_substrings_in_string, create_numpy_array_from_ds
+
+def append_dataset_to_netcdf_file(ds, file, dimension, encoding=None):
+    """ 
+    Appends an xarray Dataset to a NetCDF file along the given dimension, which must be the first dimension of all variables that have it. 
+    If the file does not exist, it is created with the dimension as an unlimited dimension. This allows writing a long time series one 
+    piece (e.g., year) at a time, so that only one piece is held in memory.
+
+    Parameters:
+        ds: Dataset to append. All variables that are not along the dimension are only written when the file is created.
+        file: Complete path and name of the NetCDF file.
+        dimension: Dimension along which to append (e.g., 'year').
+        encoding: Dictionary with the encoding of each variable (e.g., from get_netcdf_encoding()), used when the file is created.
+
+    Returns:
+        N/A.
+    """
+    if not os.path.exists(file):
+        ds.to_netcdf(file, mode='w', unlimited_dims=[dimension], encoding=encoding)
+        return
+    with netCDF4.Dataset(file, mode='a') as nc:
+        start = nc.dimensions[dimension].size
+        stop = start + ds.sizes[dimension]
+        for name, variable in ds.variables.items():
+            if dimension in variable.dims:
+                nc.variables[name][start:stop] = variable.values
+
+def create_pft_membership_matrix(num_pfts=17):
+    """ 
+    Creates the membership matrix of the plant functional type (PFT) categories: each individual PFT (except the last, empty one), followed by 
+    the aggregate PFT groups in PFT_GROUPS. Contracting this matrix with the PFT percentages over their PFT axis gives the percentages of all 
+    categories at once, instead of filtering and summing the PFTs of each category separately.
+
+    Parameters:
+        num_pfts: Number of PFTs (the size of the 'natpft' dimension), including the empty one.
+
+    Returns:
+        List of the labels of the areas of the PFT categories and a NumPy array of shape (categories x PFTs), where an entry is 1 if the PFT 
+        belongs to the category and 0 otherwise.
+    """
+    pft_labels = [f'PFT_{i+1}_AREA (km^2)' for i in range(num_pfts-1)]
+    pft_min_max_indices = [(i, i) for i in range(num_pfts-1)]
+    for group, min_max_indices in PFT_GROUPS.items():
+        pft_labels.append(f'{group}_AREA (km^2)')
+        pft_min_max_indices.append(min_max_indices)
+    membership_matrix = np.zeros((len(pft_labels), num_pfts))
+    for index, (pft_min_index, pft_max_index) in enumerate(pft_min_max_indices):
+        membership_matrix[index, pft_min_index:pft_max_index+1] = 1
+    return pft_labels, membership_matrix
+
+def estimate_memory_of_netcdf_variables(file, variables, multiplier=MEMORY_OVERHEAD_FACTOR):
+    """ 
+    Estimates the peak memory of a task that reads the given variables from a NetCDF file, from the shapes and data types of the variables.
+    Only the metadata of the file are read.
+
+    Parameters:
+        file: NetCDF file.
+        variables: List of variables read by the task. Variables that are not in the file are ignored. If None, all data variables are included.
+        multiplier: Ratio between the peak memory of the task and the size of the variables in memory (e.g., to account for Pandas DataFrames).
+
+    Returns:
+        Estimated peak memory in bytes.
+    """
+    with xr.open_dataset(file) as ds:
+        if variables is None:
+            variables = list(ds.data_vars)
+        return multiplier*sum(ds[variable].nbytes for variable in variables if variable in ds)
+
+def extract_gridcell_arrays_from_dataset(ds, variables):
+    """ 
+    Extracts the specified variables from an xarray Dataset into flat NumPy arrays over the grid cells, without going through a Pandas DataFrame.
+    The grid cells are ordered in the same way as the areas returned by find_gridcell_areas_in_netcdf_file().
+
+    Parameters:
+        ds: Dataset containing data for a single time step (e.g., from an E3SM-generated h0 NetCDF file for one month).
+        variables: List of variables to extract. Each variable must be defined only on the spatial dimensions (plus the time dimension of length 1).
+
+    Returns:
+        Dictionary where the keys are labels of the form 'variable (units)' and the values are 1D NumPy arrays with one entry per grid cell.
+    """
+    arrays = {}
+    for variable in variables:
+        label = f"{variable} ({ds[variable].attrs['units']})"
+        arrays[label] = ds[variable].to_numpy().reshape(-1)
+    return arrays
 
 def extract_year_and_month_from_name_of_netcdf_file(file):
     """ 
@@ -34,42 +124,38 @@ def extract_year_and_month_from_netcdf_file(file):
     month = ds['time'].dt.month.values[0]
     return year, month
 
-def find_gridcell_areas_in_netcdf_file(file, region=None):
+def find_gridcell_areas_in_netcdf_file(file, region=None, grid_data=None):
     """ 
     Obtains the grid cell areas of all latitude/longitude coordinates in an E3SM-generated (EAM or ELM or EHC) NetCDF file for the given region.
 
     Parameters:
         file: NetCDF file.
         region: String for the region of interest. If not specified or not recognized, then there will be no restrictions on the lat/lon coordinates. 
+        grid_data: Dictionary of static grid data for this type of NetCDF file and region, as returned by get_static_grid_data(). If provided, the 
+                   areas, land fractions, and regional selection are taken from this dictionary instead of being recomputed from the file.
 
     Returns:
         NumPy array containing the grid cell areas of all coordinates in units of m^2 and an xarray Dataset containing data from the file.
         Also returns the land and non-land (which is defined as ocean if in the case of EAM) fractions.
     """
-    # Load the file into an xarray Dataset and put the grid cell areas into a NumPy array.
+    # If the static grid data have already been computed for this simulation, only the regional selection needs to be applied to the Dataset.
+    if grid_data is not None:
+        ds = xr.open_dataset(file)
+        ds = ds.isel(get_hyperslab_indexers(grid_data['region_indices']))
+        non_landfrac = grid_data['non_landfrac']
+        if 'eam.h0' in file:
+            # The EAM ocean fraction excludes sea ice and therefore changes from month to month, so it is always read from the file itself.
+            non_landfrac = create_numpy_array_from_ds(ds, ['OCNFRAC'], [0])
+        return grid_data['areas'], ds, grid_data['landfrac'], non_landfrac
+
+    # Open the file as an xarray Dataset. Nothing is read from the file until the data are accessed.
     ds = xr.open_dataset(file)
 
-    # If a region has been specified, get the bounds on the lat/lon coordinates and apply these bounds to restrict the lat/lon coordinates.
+    # If a region has been specified, restrict the Dataset to the grid cells in the region by their positional indices, so that only these grid 
+    # cells (of only the variables that are accessed later) are read from the file. For the structured ELM and EHC grids, the indices form
+    # contiguous lat/lon ranges that are read as hyperslabs.
     if region:
-        bounds = get_regional_bounds(region)
-        lon_bounds = bounds[:2]
-        lat_bounds = bounds[2:]
-        if 'elm.h0' in file:
-            ds = ds.where((ds.lon >= lon_bounds[0]), drop=True)
-            ds = ds.where((ds.lon <= lon_bounds[1]), drop=True)
-            ds = ds.where((ds.lat >= lat_bounds[0]), drop=True)
-            ds = ds.where((ds.lat <= lat_bounds[1]), drop=True)
-        elif 'eam.h0' in file:
-            ds.load()
-            ds = ds.where((ds.lon >= lon_bounds[0]), drop=True)
-            ds = ds.where((ds.lon <= lon_bounds[1]), drop=True)
-            ds = ds.where((ds.lat >= lat_bounds[0]), drop=True)
-            ds = ds.where((ds.lat <= lat_bounds[1]), drop=True)
-        elif 'surfdata_iESM_dyn' in file:
-            ds = ds.where((ds.LONGXY >= lon_bounds[0]), drop=True)
-            ds = ds.where((ds.LONGXY <= lon_bounds[1]), drop=True)
-            ds = ds.where((ds.LATIXY >= lat_bounds[0]), drop=True)
-            ds = ds.where((ds.LATIXY <= lat_bounds[1]), drop=True)
+        ds = ds.isel(get_hyperslab_indexers(find_region_indices_in_netcdf_file(ds, file, region)))
 
     if 'elm.h0' in file:
         # If the NetCDF file is produced by the ELM model, multiply the areas by the land fraction, plus additional land and pft masks.
@@ -96,6 +182,166 @@ def find_gridcell_areas_in_netcdf_file(file, region=None):
         non_landfrac = 1 - landfrac
     return areas, ds, landfrac, non_landfrac
 
+def find_region_indices_in_netcdf_file(ds, file, region=None):
+    """ 
+    Finds the positional indices of the grid cells that fall within the bounds of the given region for an E3SM-generated NetCDF file.
+    The selection is the same as the one made by restricting the lat/lon coordinates in find_gridcell_areas_in_netcdf_file().
+
+    Parameters:
+        ds: xarray Dataset containing the data from the NetCDF file.
+        file: NetCDF file.
+        region: String for the region of interest. If not specified, all grid cells are selected.
+
+    Returns:
+        Dictionary where the keys are the spatial dimensions of the file and the values are NumPy arrays of the indices to keep along each dimension.
+        The dictionary can be passed directly to the isel() method of an xarray Dataset read from any file of the same type in the simulation.
+    """
+    if 'elm.h0' in file:
+        lon, lat = ds['lon'].to_numpy(), ds['lat'].to_numpy()
+        dims = {'lon': 'lon', 'lat': 'lat'}
+    elif 'eam.h0' in file:
+        lon, lat = ds['lon'].to_numpy(), ds['lat'].to_numpy()
+        dims = {'lon': 'ncol', 'lat': 'ncol'}
+    elif 'surfdata_iESM_dyn' in file:
+        # The surface data file stores the coordinates as 2D (lsmlat, lsmlon) arrays on a regular grid, so take one row and one column of them.
+        lon, lat = ds['LONGXY'].to_numpy()[0, :], ds['LATIXY'].to_numpy()[:, 0]
+        dims = {'lon': 'lsmlon', 'lat': 'lsmlat'}
+    if not region:
+        return {dim: np.arange(ds.sizes[dim]) for dim in set(dims.values())}
+
+    bounds = get_regional_bounds(region)
+    lon_bounds = bounds[:2]
+    lat_bounds = bounds[2:]
+    lon_mask = (lon >= lon_bounds[0]) & (lon <= lon_bounds[1])
+    lat_mask = (lat >= lat_bounds[0]) & (lat <= lat_bounds[1])
+    if dims['lon'] == dims['lat']:
+        # Unstructured (EAM) grid: the lat/lon coordinates are both indexed by the same column dimension.
+        return {dims['lon']: np.flatnonzero(lon_mask & lat_mask)}
+    return {dims['lon']: np.flatnonzero(lon_mask), dims['lat']: np.flatnonzero(lat_mask)}
+
+def get_file_catalog_path(path, catalog_directory=None):
+    """ 
+    Gets the path of the SQLite catalog of files for a given simulation directory (see update_file_catalog()).
+
+    Parameters:
+        path: Path of the simulation directory.
+        catalog_directory: Directory where the catalog is stored. If not specified, FILE_CATALOG_DIRECTORY is used.
+
+    Returns:
+        Complete path of the catalog file, which is specific to the (absolute) path of the simulation directory.
+    """
+    path_hash = hashlib.md5(os.path.abspath(path).encode()).hexdigest()[:12]
+    return os.path.join(catalog_directory or FILE_CATALOG_DIRECTORY, f'file_catalog_{path_hash}.sqlite')
+
+def get_files_from_catalog(path, file_name_substrings=None, file_extension=None, start_year=None, end_year=None, catalog_directory=None, 
+                           update_catalog=True):
+    """ 
+    Gets a list of complete paths for all files in a simulation directory by querying its file catalog instead of walking the directory. 
+    This gives the same files as get_all_files_in_path() (followed by get_netcdf_files_between_start_and_end_years() if years are given).
+
+    Parameters:
+        path: Path of the simulation directory.
+        file_name_substrings: A list of all substrings that must be in the file names.
+        file_extension: File extension that should be in all files. 
+        start_year: If specified, only files whose names contain a year (e.g., E3SM history files) at or after this year are included.
+        end_year: If specified, only files whose names contain a year (e.g., E3SM history files) at or before this year are included.
+        catalog_directory: Directory where the catalog is stored. If not specified, FILE_CATALOG_DIRECTORY is used.
+        update_catalog: Whether to update the catalog before querying it. Set this to False when the catalog has just been updated, 
+                        e.g., in worker processes after the main process has updated it.
+
+    Returns:
+        A sorted list with complete paths to all matching files in the directory. 
+    """
+    if update_catalog:
+        catalog_file = update_file_catalog(path, catalog_directory=catalog_directory)
+    else:
+        catalog_file = get_file_catalog_path(path, catalog_directory=catalog_directory)
+
+    query = 'SELECT path, name FROM files'
+    conditions, parameters = [], []
+    if start_year is not None:
+        conditions.append('year >= ?')
+        parameters.append(start_year)
+    if end_year is not None:
+        conditions.append('year <= ?')
+        parameters.append(end_year)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    with sqlite3.connect(catalog_file, timeout=60) as connection:
+        rows = connection.execute(query + ' ORDER BY path', parameters).fetchall()
+    connection.close()
+
+    file_paths = []
+    for file_path, file_name in rows:
+        if not file_name_substrings or all([substring in file_name for substring in file_name_substrings]):
+            if not file_extension or file_name.endswith(file_extension):
+                file_paths.append(file_path)
+    return file_paths
+
+def get_hyperslab_indexers(region_indices):
+    """ 
+    Converts the indices of the grid cells in a region (from find_region_indices_in_netcdf_file()) into indexers for the isel() method of an 
+    xarray Dataset. Indices that form a contiguous range (e.g., the lat/lon ranges of a region on a structured grid) are converted into slices, 
+    so that they are read from the NetCDF file as a single hyperslab rather than by fancy indexing.
+
+    Parameters:
+        region_indices: Dictionary where the keys are the spatial dimensions and the values are NumPy arrays of the indices to keep.
+
+    Returns:
+        Dictionary where the keys are the spatial dimensions and the values are slices (for contiguous indices) or NumPy arrays of indices.
+    """
+    indexers = {}
+    for dim, indices in region_indices.items():
+        if len(indices) > 0 and indices[-1] - indices[0] + 1 == len(indices):
+            indexers[dim] = slice(int(indices[0]), int(indices[-1]) + 1)
+        else:
+            indexers[dim] = indices
+    return indexers
+
+def get_netcdf_encoding(ds, compression_level=NETCDF_COMPRESSION_LEVEL, convert_to_float32=False, chunk_dimension='year'):
+    """ 
+    Creates the encoding of the data variables of an xarray Dataset for writing it to a NetCDF file with to_netcdf(): zlib compression with the 
+    shuffle filter, an optional conversion of float64 variables to float32, and chunks that hold one slice of the chunk dimension (e.g., one year 
+    of the entire grid). These chunks match how e3sm_plot_spatial_data.py reads the files (one variable over a range of years at a time), so that 
+    reading a variable decompresses only the years that are needed.
+
+    Parameters:
+        ds: Dataset to write.
+        compression_level: zlib compression level from 0 to 9, where 0 means no compression.
+        convert_to_float32: Boolean that indicates if float64 variables should be stored as float32, which halves their size.
+        chunk_dimension: Dimension along which each chunk holds a single slice.
+
+    Returns:
+        Dictionary where the keys are the data variables and the values are their encodings.
+    """
+    encoding = {}
+    for name, variable in ds.data_vars.items():
+        variable_encoding = {}
+        if compression_level > 0:
+            variable_encoding.update({'zlib': True, 'complevel': compression_level, 'shuffle': True})
+        if convert_to_float32 and variable.dtype == np.float64:
+            variable_encoding['dtype'] = 'float32'
+        if chunk_dimension in variable.dims:
+            variable_encoding['contiguous'] = False
+            variable_encoding['chunksizes'] = tuple(1 if dim == chunk_dimension else size for dim, size in zip(variable.dims, variable.shape))
+        encoding[name] = variable_encoding
+    return encoding
+
+def get_netcdf_file_type(file):
+    """ 
+    Finds the type of an E3SM-generated NetCDF file from its name.
+
+    Parameters:
+        file: NetCDF file.
+
+    Returns:
+        String for the file type ('elm.h0', 'eam.h0', or 'surfdata_iESM_dyn'), or None if the type is not recognized.
+    """
+    for file_type in ['elm.h0', 'eam.h0', 'surfdata_iESM_dyn']:
+        if file_type in file:
+            return file_type
+    return None
+
 def get_netcdf_files_between_start_and_end_years(files, start_year, end_year):
     """ 
     Finds all E3SM-generated NetCDF files in a given list that fall between the start and end years.
@@ -115,6 +361,38 @@ def get_netcdf_files_between_start_and_end_years(files, start_year, end_year):
             new_file_paths.append(file)
     return new_file_paths
 
+def get_region_matrix(file, regions):
+    """ 
+    Creates a sparse (regions x grid cells) matrix whose rows indicate which grid cells of an E3SM-generated NetCDF file belong to each region.
+    Multiplying this matrix with a vector over all grid cells of the (global) grid produces the sums over every region at once, so that all regional
+    time series can be obtained from a single read of each file. The selection for each region is the same as in find_region_indices_in_netcdf_file().
+
+    Parameters:
+        file: NetCDF file.
+        regions: List of strings for the regions of interest. None or 'global' indicates that the entire globe (all grid cells) should be used.
+
+    Returns:
+        SciPy sparse matrix in CSR format with one row per region and one column per grid cell (in the same order as the areas returned by 
+        find_gridcell_areas_in_netcdf_file()), where an entry is 1 if the grid cell belongs to the region and 0 otherwise.
+    """
+    with xr.open_dataset(file) as ds:
+        if 'elm.h0' in file:
+            lon, lat = np.meshgrid(ds['lon'].to_numpy(), ds['lat'].to_numpy())
+        elif 'eam.h0' in file:
+            lon, lat = ds['lon'].to_numpy(), ds['lat'].to_numpy()
+        elif 'surfdata_iESM_dyn' in file:
+            lon, lat = ds['LONGXY'].to_numpy(), ds['LATIXY'].to_numpy()
+    lon, lat = lon.reshape(-1), lat.reshape(-1)
+
+    masks = []
+    for region in regions:
+        if not region or region == 'global':
+            masks.append(np.ones(lon.size, dtype=bool))
+        else:
+            bounds = get_regional_bounds(region)
+            masks.append((lon >= bounds[0]) & (lon <= bounds[1]) & (lat >= bounds[2]) & (lat <= bounds[3]))
+    return sparse.csr_matrix(np.array(masks, dtype=np.float64))
+
 def get_regional_bounds(region):
     """
     Finds and returns a NumPy array that indicates the bounds on the longitude and latitude for given a geographical region.
@@ -174,4 +452,208 @@ def get_regional_bounds(region):
     bounds = np.array(bounds) 
     # Convert the longitudinal bounds to be between 0 and 360.
     bounds[:2] += 180
-    return bounds
\ No newline at end of file
+    return bounds
+
+def get_static_grid_data(file, region=None, cache_directory=None):
+    """ 
+    Gets the static (time-invariant) grid data of an E3SM-generated NetCDF file for the given region: the grid cell areas, the land and non-land 
+    fractions, and the indices of the grid cells that fall within the region. These fields do not change over the course of a simulation, so they
+    can be computed once from any file of a given type and then reused for all other files of the same type in the simulation. The one exception
+    is the EAM ocean fraction, which varies with sea ice and is therefore read again from each file by find_gridcell_areas_in_netcdf_file().
+
+    Parameters:
+        file: NetCDF file.
+        region: String for the region of interest. If not specified or not recognized, then there will be no restrictions on the lat/lon coordinates.
+        cache_directory: Directory where the static grid data are saved to (and subsequently loaded from) a .npz file. If not specified, the grid 
+                         data are computed from the file and are not saved.
+
+    Returns:
+        Dictionary containing the grid cell areas ('areas'), land fractions ('landfrac'), non-land fractions ('non_landfrac'), and a dictionary of
+        the indices along each spatial dimension for the grid cells in the region ('region_indices').
+    """
+    # The cache file is specific to the simulation (the directory containing the NetCDF file), the type of NetCDF file, and the region. It is only 
+    # valid for the same bounds of the region and dimensions of the grid, so these are hashed into its name as well, so that changed region 
+    # definitions or a regridded simulation in the same directory never reuse stale grid data.
+    file_type = get_netcdf_file_type(file)
+    cache_file = None
+    with xr.open_dataset(file) as ds:
+        if cache_directory is not None:
+            simulation_hash = hashlib.md5(os.path.dirname(os.path.abspath(file)).encode()).hexdigest()[:12]
+            bounds = [float(bound) for bound in get_regional_bounds(region)] if region else None
+            grid_sizes = sorted((dim, size) for dim, size in ds.sizes.items() if dim != 'time')
+            validity_hash = hashlib.md5(str((bounds, grid_sizes)).encode()).hexdigest()[:12]
+            cache_file = os.path.join(cache_directory, f'grid_cache_{file_type}_{region or "global"}_{simulation_hash}_{validity_hash}.npz')
+            if os.path.exists(cache_file):
+                with np.load(cache_file) as cache:
+                    grid_data = {key: cache[key] for key in ['areas', 'landfrac', 'non_landfrac']}
+                    grid_data['region_indices'] = {key[len('region_indices_'):]: cache[key] for key in cache.files if key.startswith('region_indices_')}
+                return grid_data
+
+        # Compute the static fields from the regional subset of the file.
+        region_indices = find_region_indices_in_netcdf_file(ds, file, region)
+    areas, ds_file, landfrac, non_landfrac = find_gridcell_areas_in_netcdf_file(file, region=region)
+    ds_file.close()
+    grid_data = {'areas': areas, 'landfrac': landfrac, 'non_landfrac': non_landfrac, 'region_indices': region_indices}
+
+    # Save the static grid data so that subsequent runs for the same simulation and region do not need to compute them again. The cache file is 
+    # written under a temporary name first, so that other processes never read a partially written cache file.
+    if cache_file:
+        os.makedirs(cache_directory, exist_ok=True)
+        temporary_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(temporary_file, 'wb') as f:
+            np.savez(f, areas=areas, landfrac=landfrac, non_landfrac=non_landfrac, 
+                     **{f'region_indices_{dim}': indices for dim, indices in region_indices.items()})
+        os.replace(temporary_file, cache_file)
+    return grid_data
+
+def parse_name_of_e3sm_file(file_name):
+    """ 
+    Finds the component, history tape, year, and month from the name of an E3SM output file, e.g., 'case.elm.h0.2015-01.nc' or 
+    'case.eam.r.2015-01-01-00000.nc'.
+
+    Parameters:
+        file_name: Name of the file (without the directory).
+
+    Returns:
+        The component (e.g., 'elm'), history tape (e.g., 'h0' or 'r'), year, and month indicated in the name of the file. 
+        All four are None if the name does not follow the E3SM naming convention (e.g., log files or surfdata_iESM_dyn.nc).
+    """
+    match = re.search(r'\.([a-z]+)\.(h\d+[a-z]?|rh\d+|r|i)\.(\d{4})-(\d{2})', file_name)
+    if not match:
+        return None, None, None, None
+    return match.group(1), match.group(2), int(match.group(3)), int(match.group(4))
+
+def reduce_gridcell_arrays(arrays, lat_lon_aggregation_type, areas, landfrac, non_landfrac, region_matrix=None):
+    """ 
+    Performs the lat/lon aggregation of variables stored as flat NumPy arrays over the grid cells, reducing each variable to a single value.
+    The 'area_weighted_mean_or_sum' aggregation is a single dot product of each variable with a precomputed weight vector (the grid cell areas, 
+    multiplied by the land or non-land fractions for '_LND' or '_OCN' variables). Fluxes and stocks (per-area quantities with '/m^2' or '/m2' in 
+    their units) become area-weighted sums and all other variables become area-weighted means, as in e3sm_extract_time_series_h0.py. 
+    Labels containing 'AREA' are already areas and are summed without weighting. NaN values are skipped, as in Pandas sums and means.
+
+    Parameters:
+        arrays: Dictionary where the keys are labels of the form 'variable (units)' and the values are 1D NumPy arrays with one entry per grid cell.
+        lat_lon_aggregation_type: String that indicates how to aggregate over the grid cells: 'area_weighted_mean_or_sum', 'mean', or 'sum'.
+        areas: NumPy array containing the grid cell areas.
+        landfrac: NumPy array containing the land fractions of the grid cells.
+        non_landfrac: NumPy array containing the non-land (ocean in the case of EAM) fractions of the grid cells.
+        region_matrix: Optional sparse (regions x grid cells) matrix from get_region_matrix(). If provided, each variable is reduced over every 
+                       region at once (one sparse matrix-vector product per variable) instead of over all grid cells.
+
+    Returns:
+        Dictionary where the keys are the labels (with '/m^2' or '/m2' removed from the units of area-weighted sums) and the values are the 
+        aggregated values of the variables. If region_matrix is provided, each value is a NumPy array with one entry per region.
+    """
+    # Without a region matrix, the reduction is over all grid cells, which is equivalent to a region matrix with a single row of ones.
+    def sum_over_gridcells(array, weight=None):
+        if weight is not None:
+            array = array*weight
+        if region_matrix is None:
+            return np.sum(array, dtype=np.float64)
+        return region_matrix @ array.astype(np.float64)
+
+    values = {}
+    if lat_lon_aggregation_type == 'area_weighted_mean_or_sum':
+        areas = areas.reshape(-1).astype(np.float64)
+        landfrac = landfrac.reshape(-1)
+        non_landfrac = non_landfrac.reshape(-1)
+        total_areas = {'': sum_over_gridcells(areas), '_LND': sum_over_gridcells(areas, landfrac), '_OCN': sum_over_gridcells(areas, non_landfrac)}
+        # Weight vectors are keyed by whether the label is an area and whether it is a land or non-land quantity, and each is computed only once.
+        # With a region matrix, the weights are folded into the columns of the matrix, so that each variable needs only one sparse product.
+        weights = {}
+        for label, array in arrays.items():
+            is_area, is_land, is_non_land = 'AREA' in label, '_LND' in label, '_OCN' in label
+            key = (is_area, is_land, is_non_land)
+            if key not in weights:
+                weight = np.ones_like(areas) if is_area else areas
+                # For EAM variables that correspond specifically to land or non-land (ocean) quantities, multiply by the land or non-land fractions.
+                if is_land:
+                    weight = weight*landfrac
+                if is_non_land:
+                    weight = weight*non_landfrac
+                weights[key] = weight if region_matrix is None else region_matrix.multiply(weight).tocsr()
+            array = np.nan_to_num(array, nan=0)
+            value = np.dot(array, weights[key]) if region_matrix is None else weights[key] @ array
+            # Variables that are not fluxes and stocks (so that they are not per-area quantities) should be area-weighted means rather than 
+            # area-weighted sums, so divide their sums by the total area (of land or non-land if appropriate).
+            if not is_area and not check_substrings_in_string(['/m^2', '/m2'], label, all_or_any='any'):
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    if is_land:
+                        value = value/total_areas['_LND']
+                    if is_non_land:
+                        value = value/total_areas['_OCN']
+                    if not is_land and not is_non_land:
+                        value = value/total_areas['']
+            # Fluxes and stocks are area-weighted sums and have been multiplied by areas, so remove the '/m^2' part of their units.
+            values[label.replace('/m^2', '').replace('/m2', '')] = value
+    elif lat_lon_aggregation_type == 'sum':
+        for label, array in arrays.items():
+            values[label] = sum_over_gridcells(np.nan_to_num(array, nan=0))
+    elif lat_lon_aggregation_type == 'mean':
+        for label, array in arrays.items():
+            num_values = sum_over_gridcells(~np.isnan(array))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values[label] = sum_over_gridcells(np.nan_to_num(array, nan=0))/num_values
+    return values
+
+def update_file_catalog(path, catalog_directory=None):
+    """ 
+    Updates the SQLite catalog of all files in a simulation directory (and its subdirectories), which records the component, history tape, year, 
+    month, size, and modification time of each file. Walking a run directory with tens of thousands of files on a parallel file system is slow, 
+    so the catalog is updated incrementally: the files in a directory are listed and stat'ed again only if the modification time of the directory 
+    has changed (i.e., files were added, removed, or renamed in it). Files that are modified in place without changing their directory are 
+    therefore not re-stat'ed; delete the catalog file to rebuild it from scratch.
+
+    Parameters:
+        path: Path of the simulation directory.
+        catalog_directory: Directory where the catalog is stored. If not specified, FILE_CATALOG_DIRECTORY is used.
+
+    Returns:
+        Complete path of the catalog file.
+    """
+    path = os.path.abspath(path)
+    catalog_file = get_file_catalog_path(path, catalog_directory=catalog_directory)
+    os.makedirs(os.path.dirname(catalog_file), exist_ok=True)
+
+    with sqlite3.connect(catalog_file, timeout=60) as connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, parent TEXT, mtime REAL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, directory TEXT, name TEXT, component TEXT, tape TEXT, '
+                           'year INTEGER, month INTEGER, size INTEGER, mtime REAL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS files_directory ON files (directory)')
+        known_mtimes, known_subdirectories = {}, {}
+        for directory, parent, mtime in connection.execute('SELECT path, parent, mtime FROM directories'):
+            known_mtimes[directory] = mtime
+            known_subdirectories.setdefault(parent, []).append(directory)
+
+        # Walk the directory tree, only listing the contents of directories that are new or have changed since the last update.
+        visited_directories = set()
+        stack = [(path, None)]
+        while stack:
+            directory, parent = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime
+            except FileNotFoundError:
+                continue
+            visited_directories.add(directory)
+            if known_mtimes.get(directory) == mtime:
+                stack.extend((subdirectory, directory) for subdirectory in known_subdirectories.get(directory, []))
+                continue
+            rows, subdirectories = [], []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        rows.append((entry.path, directory, entry.name, *parse_name_of_e3sm_file(entry.name), stat.st_size, stat.st_mtime))
+            connection.execute('DELETE FROM files WHERE directory = ?', (directory,))
+            connection.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            connection.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)', (directory, parent, mtime))
+            stack.extend((subdirectory, directory) for subdirectory in subdirectories)
+
+        # Remove directories (and their files) that no longer exist.
+        for directory in set(known_mtimes) - visited_directories:
+            connection.execute('DELETE FROM files WHERE directory = ?', (directory,))
+            connection.execute('DELETE FROM directories WHERE path = ?', (directory,))
+    connection.close()
+    return catalog_file
@@ -0,0 +1,111 @@
+import os
+import pandas as pd
+from utility_constants import COLUMNAR_FILE_EXTENSIONS, PARSED_FILE_CACHE_SUFFIX
+
+def is_columnar_file(file_name):
+    """ 
+    Checks if a file is in one of the binary columnar formats (Parquet or Feather), based on its file extension.
+
+    Parameters:
+        file_name: Name of the file.
+
+    Returns:
+        True if the file extension is one of COLUMNAR_FILE_EXTENSIONS, False otherwise.
+    """
+    return file_name.endswith(COLUMNAR_FILE_EXTENSIONS)
+
+def read_data_file_into_dataframe(file_name, clean_up_df=False):
+    """ 
+    Reads a data file into a Pandas DataFrame, choosing the format from the file extension: Parquet (.parquet) and Feather (.feather) files are
+    read directly, and all other files are read as csv or fixed-width-format files by read_file_into_dataframe(). The binary columnar formats 
+    store the column labels (including their units) and data types as they are, so they are much faster to read than text files and do not
+    need to be cleaned up.
+
+    Parameters:
+        file_name: Complete path and name of the file.
+        clean_up_df: Boolean that specifies if we want to call clean_up_dataframe() on the DataFrame of a csv or fixed-width-format file.
+
+    Returns:
+        DataFrame containing the contents of the file.
+    """
+    if file_name.endswith('.parquet'):
+        return pd.read_parquet(file_name)
+    if file_name.endswith('.feather'):
+        return pd.read_feather(file_name)
+    # Text files are handled by utility_dataframes, which is only imported here so that the columnar formats do not depend on it.
+    from utility_dataframes import read_file_into_dataframe
+    return read_file_into_dataframe(file_name, clean_up_df=clean_up_df)
+
+def read_data_file_into_dataframe_with_cache(file_name, columns=None, clean_up_df=False):
+    """ 
+    Reads a data file into a Pandas DataFrame like read_data_file_into_dataframe(), but parses a csv or fixed-width-format file only once. The parsed 
+    DataFrame is stored in a Parquet sidecar file next to the text file (with the suffix PARSED_FILE_CACHE_SUFFIX), together with the modification
+    time and size of the text file. Later calls (e.g., from other plotting tasks that need the same file) read the sidecar instead of parsing the 
+    text file again, as long as the text file has not changed since. If the sidecar cannot be written (e.g., in a read-only directory), the parsed 
+    DataFrame is still returned.
+
+    Parameters:
+        file_name: Complete path and name of the file.
+        columns: List of the columns to read. If None, all columns are read. Only these columns are read from a columnar file.
+        clean_up_df: Boolean that specifies if we want to call clean_up_dataframe() on the DataFrame of a csv or fixed-width-format file.
+
+    Returns:
+        DataFrame containing the contents of the file.
+    """
+    if is_columnar_file(file_name):
+        if file_name.endswith('.parquet'):
+            return pd.read_parquet(file_name, columns=columns)
+        return pd.read_feather(file_name, columns=columns)
+
+    # The sidecar is valid only for the current version of the text file and for the same clean-up option.
+    status = os.stat(file_name)
+    key = {'source_mtime_ns': status.st_mtime_ns, 'source_size': status.st_size, 'clean_up_df': clean_up_df}
+    cache_file = file_name + PARSED_FILE_CACHE_SUFFIX
+    # The whole sidecar is read before selecting the columns, so that a stale sidecar without a newly added column is detected and replaced
+    # instead of failing to read. A sidecar that cannot be read (e.g., a corrupted file or a different version of the library) is also replaced.
+    if os.path.exists(cache_file):
+        try:
+            df = pd.read_parquet(cache_file)
+        except Exception:
+            df = None
+        if df is not None and df.attrs == key:
+            df.attrs = {}
+            if columns is not None:
+                df = df[columns]
+            return df
+
+    # Parse the text file and write the sidecar to a temporary file first, so that other processes never read a partially written sidecar.
+    from utility_dataframes import read_file_into_dataframe
+    df = read_file_into_dataframe(file_name, clean_up_df=clean_up_df)
+    temporary_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        df.attrs = key
+        df.to_parquet(temporary_file, index=False)
+        os.replace(temporary_file, cache_file)
+    except (ImportError, OSError, TypeError, ValueError):
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+    df.attrs = {}
+    if columns is not None:
+        df = df[columns]
+    return df
+
+def write_dataframe_to_data_file(df, file_name):
+    """ 
+    Writes a Pandas DataFrame to a data file, choosing the format from the file extension: Parquet (.parquet) or Feather (.feather), and otherwise
+    csv or fixed-width format as in write_dataframe_to_file(). The index of the DataFrame is not written.
+
+    Parameters:
+        df: The DataFrame to write.
+        file_name: Complete path and name of the output file.
+
+    Returns:
+        N/A.
+    """
+    if file_name.endswith('.parquet'):
+        df.to_parquet(file_name, index=False)
+    elif file_name.endswith('.feather'):
+        df.reset_index(drop=True).to_feather(file_name)
+    else:
+        from utility_dataframes import write_dataframe_to_file
+        write_dataframe_to_file(df, file_name)
@@ -1,6 +1,11 @@
+from concurrent.futures import as_completed
+import multiprocessing
 import numpy as np
 import os
+import queue
 import re
+import threading
+from utility_constants import EXECUTORS, MAX_PROCESSES, MAX_PROCESSES_WITH_MEMORY_ESTIMATE, MEMORY_OVERHEAD_FACTOR, MEMORY_SAFETY_FRACTION
 
 def add_lists_elementwise(list1, list2, list2_are_units=False):
     """
@@ -94,6 +99,32 @@ def create_numpy_array_from_ds(ds, variables, fill_nan_values):
     else:
         return np_arrays
     
+def create_process_pool(num_tasks=None, memory_per_task=None):
+    """
+    Creates a multiprocessing Pool whose number of worker processes is sized by get_number_of_processes().
+
+    Parameters:
+        num_tasks: Number of tasks that will be run in the pool. No more processes than tasks are created.
+        memory_per_task: Estimated peak memory (in bytes) of a single task. If not specified, the pool has at most MAX_PROCESSES processes.
+
+    Returns:
+        multiprocessing Pool.
+    """
+    return multiprocessing.Pool(processes=get_number_of_processes(num_tasks=num_tasks, memory_per_task=memory_per_task))
+
+def estimate_memory_of_files(files, multiplier=MEMORY_OVERHEAD_FACTOR):
+    """
+    Estimates the peak memory of a task that reads the given files (e.g., csv files read into Pandas DataFrames) from the sizes of the files.
+
+    Parameters:
+        files: List of files read by the task. Files that do not exist are ignored.
+        multiplier: Ratio between the peak memory of the task and the total size of the files.
+
+    Returns:
+        Estimated peak memory in bytes.
+    """
+    return multiplier*sum(os.path.getsize(file) for file in files if os.path.isfile(file))
+
 def find_between_chars(text, start_char, end_char):
     """
     Finds and returns the substring located between the first occurrence of start_char and the first occurrence of end_char after start_char.
@@ -136,6 +167,168 @@ def get_all_files_in_path(path, file_name_substrings=None, file_extension=None):
                     file_paths.append(file_path)
     return file_paths
 
+def get_available_memory():
+    """
+    Gets the memory that is currently available to this process, i.e., the smaller of the memory available on the node (MemAvailable in 
+    /proc/meminfo) and the memory remaining under the limit of the control group (cgroup) of the process (e.g., a Slurm job allocation).
+
+    Parameters:
+        N/A.
+
+    Returns:
+        Available memory in bytes, or None if it cannot be determined (e.g., on a system without /proc/meminfo).
+    """
+    available_memory = []
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available_memory.append(int(line.split()[1])*1024)
+                    break
+    except OSError:
+        pass
+
+    # Check the memory limit and current usage of the cgroup (version 2 first, then version 1), where a limit of 'max' means no limit.
+    for limit_file, usage_file in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'), 
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            with open(usage_file) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if limit.isdigit() and int(limit) < 2**60:
+            available_memory.append(max(int(limit) - usage, 0))
+        break
+    return min(available_memory) if available_memory else None
+
+def get_number_of_processes(num_tasks=None, memory_per_task=None):
+    """
+    Finds the number of worker processes to use for a set of tasks. If the peak memory of a task has been estimated, as many processes are used as 
+    there are CPU cores available to this process (but at most MAX_PROCESSES_WITH_MEMORY_ESTIMATE), as long as their total estimated memory fits 
+    within the available memory (see get_available_memory()). Otherwise, at most MAX_PROCESSES processes are used.
+
+    Parameters:
+        num_tasks: Number of tasks. No more processes than tasks are used.
+        memory_per_task: Estimated peak memory (in bytes) of a single task.
+
+    Returns:
+        Number of processes, which is at least 1.
+    """
+    if memory_per_task is None:
+        num_processes = MAX_PROCESSES
+    else:
+        num_processes = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        num_processes = min(num_processes, MAX_PROCESSES_WITH_MEMORY_ESTIMATE)
+        available_memory = get_available_memory()
+        if available_memory is not None and memory_per_task > 0:
+            num_processes = min(num_processes, int(MEMORY_SAFETY_FRACTION*available_memory // memory_per_task))
+    if num_tasks is not None:
+        num_processes = min(num_processes, num_tasks)
+    return max(num_processes, 1)
+
+def imap_unordered_in_process_pool(function, tasks, memory_per_task=None):
+    """
+    Runs a function on each task in a process pool from create_process_pool() and yields the results as they complete, applying backpressure 
+    based on memory: a new task is only started when a worker is free and the available memory (see get_available_memory()) can accommodate 
+    another task. If not, the next task waits until a running task completes. A task is always started if no other task is running. New tasks
+    are started as soon as a running task completes, without waiting for the caller to process the yielded results. Tasks that 
+    have just been started have not allocated their memory yet, so the estimated memory of all running tasks is reserved against the memory that 
+    was available when the pool started, and the memory that is currently available must also accommodate another task (e.g., in case other 
+    programs on the node have used some of it).
+
+    Parameters:
+        function: Function that takes a single task as its argument. It must be defined at the top level of a module so that it can be pickled.
+        tasks: List of tasks.
+        memory_per_task: Estimated peak memory (in bytes) of a single task. If not specified, no backpressure is applied.
+
+    Returns:
+        Generator over the results of the function for all tasks, in the order in which they complete.
+    """
+    def enough_memory(num_running):
+        if memory_per_task is None or initial_available_memory is None:
+            return True
+        reserved_memory = num_running*memory_per_task
+        available_memory = get_available_memory()
+        return MEMORY_SAFETY_FRACTION*initial_available_memory - reserved_memory >= memory_per_task and \
+               (available_memory is None or MEMORY_SAFETY_FRACTION*available_memory >= memory_per_task)
+
+    # Start as many tasks as there are free workers and enough memory for (always at least one if no other task is running). This is called 
+    # whenever a task completes from the thread of the pool that handles results, so that the workers are kept busy while the caller is still 
+    # processing earlier results, and it is protected by a lock because the first tasks are started from the main thread.
+    def start_tasks():
+        nonlocal next_task_index, num_running
+        while not stopped and next_task_index < len(tasks) and num_running < num_processes and (num_running == 0 or enough_memory(num_running)):
+            pool.apply_async(function, (tasks[next_task_index],), callback=lambda result: complete_task(True, result), 
+                             error_callback=lambda error: complete_task(False, error))
+            next_task_index += 1
+            num_running += 1
+
+    def complete_task(succeeded, result):
+        nonlocal num_running
+        with lock:
+            num_running -= 1
+            start_tasks()
+        results.put((succeeded, result))
+
+    initial_available_memory = get_available_memory()
+    num_processes = get_number_of_processes(num_tasks=len(tasks), memory_per_task=memory_per_task)
+    results = queue.Queue()
+    lock = threading.Lock()
+    next_task_index, num_running, stopped = 0, 0, False
+    with multiprocessing.Pool(processes=num_processes) as pool:
+        try:
+            with lock:
+                start_tasks()
+            for _ in range(len(tasks)):
+                succeeded, result = results.get()
+                if not succeeded:
+                    raise result
+                yield result
+        finally:
+            # Stop starting new tasks before the pool is terminated (e.g., after an error or if the caller stops early).
+            with lock:
+                stopped = True
+
+def imap_unordered_with_executor(function, tasks, executor=EXECUTORS[0], memory_per_task=None):
+    """
+    Runs a function on each task with one of the executors in EXECUTORS and yields the results as they complete. The executors are:
+        'multiprocessing': A process pool on this node (see imap_unordered_in_process_pool()).
+        'mpi': An mpi4py.futures.MPIPoolExecutor, which distributes the tasks over the MPI processes of the job across nodes. Launch the script with 
+               `mpiexec -n <number of processes> python -m mpi4py.futures <script> ...`, so that one process runs the script and the others are workers.
+        'dask': A dask.distributed Client, which connects to the scheduler given by the DASK_SCHEDULER_ADDRESS environment variable (e.g., one started 
+                with dask-scheduler and dask-worker on several nodes) or, if none is given, to a local cluster of worker processes on this node.
+    The results arrive in an order that depends on the executor, so callers must put them into a deterministic order (e.g., sort by year) before 
+    writing them, so that all executors produce the same output files.
+
+    Parameters:
+        function: Function that takes a single task as its argument. It must be defined at the top level of a module so that it can be pickled.
+        tasks: List of tasks.
+        executor: One of EXECUTORS.
+        memory_per_task: Estimated peak memory (in bytes) of a single task. Only used by the 'multiprocessing' executor, since the workers of the 
+                         other executors manage their own memory.
+
+    Returns:
+        Generator over the results of the function for all tasks, in the order in which they complete.
+    """
+    if executor == 'multiprocessing':
+        yield from imap_unordered_in_process_pool(function, tasks, memory_per_task=memory_per_task)
+    elif executor == 'mpi':
+        from mpi4py.futures import MPIPoolExecutor
+        with MPIPoolExecutor() as pool:
+            futures = [pool.submit(function, task) for task in tasks]
+            for future in as_completed(futures):
+                yield future.result()
+    elif executor == 'dask':
+        from dask.distributed import Client, as_completed as as_completed_in_dask
+        with Client() as client:
+            futures = client.map(function, tasks, pure=False)
+            for future in as_completed_in_dask(futures):
+                yield future.result()
+    else:
+        raise ValueError(f'Unknown executor {executor}; the possible executors are {", ".join(EXECUTORS)}.')
+
 def modify_list_based_on_condition(original_list, condition, new_value_function):
     """
     Modifies a list by applying a condition and a function to generate new values.
@@ -150,6 +343,27 @@ def modify_list_based_on_condition(original_list, condition, new_value_function)
     """
     return [new_value_function(element) if condition(element) else element for element in original_list]
 
+def parse_command_line_arguments(arguments):
+    """
+    Separates the command-line arguments of a script into positional arguments (e.g., JSON input files) and options of the form --name or 
+    --name=value, such as --resume or --executor=dask.
+
+    Parameters:
+        arguments: List of command-line arguments, excluding the name of the script (i.e., sys.argv[1:]).
+
+    Returns:
+        List of the positional arguments, and a dictionary that maps the name of each option (with dashes replaced by underscores) to its value 
+        (True for options without a value).
+    """
+    positional_arguments, options = [], {}
+    for argument in arguments:
+        if argument.startswith('--'):
+            name, _, value = argument[2:].partition('=')
+            options[name.replace('-', '_')] = value if value else True
+        else:
+            positional_arguments.append(argument)
+    return positional_arguments, options
+
 def print_p_values(ttest, variable, p_value_threshold, p_value_file, output_file_or_label, p_value_file_print_only_if_below_threshold):
     """
     Prints the p-values from a t-test to the console and optionally prints to an output file.
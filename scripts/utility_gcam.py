@@ -28,6 +28,9 @@ gcam_crop_mappings = {'biomass': 'BioenergyCrop', 'biomassGrass': 'BioenergyCrop
         'FodderHerbC4': 'FodderHerb', 'FruitsTree': 'Fruits', 'MiscCropC4': 'MiscCrop', 'MiscCropTree': 'MiscCrop', 'NutsSeedsTree': 'NutsSeeds',
         'OilCropTree': 'OilCrop', 'OilPalmTree': 'OilPalm', 'OtherGrainC4': 'OtherGrain', 'SugarCropC4': 'SugarCrop'}
 
+""" Lookup tables of landtype groups (see get_landtype_group_lookup()), keyed by the landtype groups, so each lookup table is built once. """
+landtype_group_lookups = {}
+
 """ Dictionary of GCAM basin names (keys) and their abbreviations (values). """
 gcam_basin_names_and_abbrevations = {
 'Africa_East_Central_Coast': 'AfrCstE', 'Africa_Red_Sea_Gulf_of_Aden_Coast': 'AfrCstNE', 'Africa_North_Interior': 'AfrIntN', 'Congo': 'CongoR',
@@ -92,48 +95,115 @@ def modify_crop_names(df, columns, mean_or_sum_if_more_than_one_row_for_crop_nam
     Parameters:
         df: DataFrame to modify.
         columns: Columns over which to perform the aggregation (group-by) operation.
-        mean_or_sum_if_more_than_one_row_for_crop_name: Specifies whether to calculate a mean or a sum after performing the aggregation.
+        mean_or_sum_if_more_than_one_row_for_crop_name: Specifies whether to calculate a mean, a sum, or an area-weighted mean ('mean', 'sum', or 'area_weighted_mean')
+                                                        after performing the aggregation. Areas are summed in the 'mean' and 'area_weighted_mean' cases.
 
     Returns:
         DataFrame with the crop names modified so that they belong to the modified common set.
     """
+    # Categorical columns can only take values that are already categories, so the modified crop names are added as categories first.
+    # Only the combinations of categories present in the data are kept by the aggregations below, so the unused crop names do not appear.
+    categorical_cols = [col for col in df.select_dtypes('category').columns if df[col].cat.categories.isin(list(gcam_crop_mappings)).any()]
+    if categorical_cols:
+        df = df.copy()
+        for col in categorical_cols:
+            new_categories = pd.Index(gcam_crop_mappings.values()).unique().difference(df[col].cat.categories)
+            df[col] = df[col].cat.add_categories(new_categories)
     df = df.replace(gcam_crop_mappings)
     if mean_or_sum_if_more_than_one_row_for_crop_name == 'mean':
-        mean_df = df.groupby(columns).mean().reset_index()
-        # Areas should be summed, not averaged, even in the 'mean' case.
-        if 'area' in df.columns:
-            area_sum = df.groupby(columns)['area'].sum().reset_index()
-            # Replace/merge the area column in mean_df.
-            mean_df = mean_df.drop(columns='area', errors='ignore').merge(area_sum, on=columns)
-        return mean_df
+        # Areas should be summed, not averaged, even in the 'mean' case, so both are calculated in the same aggregation.
+        value_cols = [col for col in df.columns if col not in columns]
+        aggregations = {col: 'sum' if col == 'area' else 'mean' for col in value_cols}
+        mean_df = df.groupby(columns, observed=True).agg(aggregations)
+        if 'area' in mean_df.columns:
+            mean_df = mean_df[[col for col in value_cols if col != 'area'] + ['area']]
+        return mean_df.reset_index()
     elif mean_or_sum_if_more_than_one_row_for_crop_name == 'sum':
-        return df.groupby(columns).sum().reset_index()
+        return df.groupby(columns, observed=True).sum().reset_index()
     elif mean_or_sum_if_more_than_one_row_for_crop_name == 'area_weighted_mean':
         # Identify columns to be averaged (these are numeric, non-area columns that are not part of the aggregation operation).
         numeric_cols = df.select_dtypes('number').columns.tolist()
         numeric_cols = [col for col in numeric_cols if col not in columns + ['area']]
 
-        # Define a function to compute area-weighted mean for each group.
-        def weighted_mean(g):
-            result = {}
-            total_area = g['area'].sum()
-            for col in numeric_cols:
-                if total_area != 0:
-                    result[col] = (g[col] * g['area']).sum() / total_area
-                else:
-                    result[col] = 0
-                    # result[col] = float('nan')  # Avoid division by zero.
-            result['area'] = total_area
-            return pd.Series(result)
-
-        # Apply the weighted mean function to each group.
-        return df.groupby(columns).apply(weighted_mean).reset_index()
+        # Sum the products of the values and areas and the areas themselves in a single aggregation, then divide once.
+        weighted_df = df[numeric_cols].mul(df['area'], axis=0)
+        weighted_df['area'] = df['area'].astype(float)
+        sums = weighted_df.groupby([df[col] for col in columns], observed=True).sum()
+        total_area = sums['area']
+        mean_df = sums[numeric_cols].div(total_area, axis=0)
+        # Groups with a total area of zero are given a value of zero instead of dividing by zero.
+        mean_df.loc[total_area == 0, :] = 0
+        mean_df['area'] = total_area
+        return mean_df.reset_index()
     
+def get_landtype_group_lookup(landtype_groups):
+    """
+    Gets a lookup table that maps each landtype to the landtype group (e.g., crop, forest, pasture, shrub, grass) it belongs to.
+    The table is built only once per process for each dictionary of landtype groups and then reused, so it must not be modified.
+
+    Parameters:
+        landtype_groups: Dictionary where the keys are landtype group names and the values are all the landtypes that belong to each group
+                         (e.g., gcam_landtype_groups or gcam_landtype_groups_original). Each landtype should belong to only one group.
+
+    Returns:
+        Pandas Series with the landtypes as the index and their landtype groups as categorical values, with the categories in the order of the dictionary.
+    """
+    key = tuple((group, tuple(landtypes)) for group, landtypes in landtype_groups.items())
+    if key not in landtype_group_lookups:
+        groups_of_landtypes = {landtype: group for group, landtypes in landtype_groups.items() for landtype in landtypes}
+        groups = pd.Categorical(list(groups_of_landtypes.values()), categories=list(landtype_groups))
+        landtype_group_lookups[key] = pd.Series(groups, index=list(groups_of_landtypes))
+    return landtype_group_lookups[key]
+
+def produce_dataframe_for_landtype_groups(df, categories, category_label, value_label, 
+                landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns):
+    """ 
+    Aggregates the rows of a given Pandas DataFrame that match each of the specified landtype groups (e.g., crop, forest, pasture, shrub, grass).
+    Performs one of four user-specified operations on the rows in each group: mean, sum, area-weighted mean, or area-weighted sum.
+    Every landtype is mapped to its group with the lookup table from get_landtype_group_lookup(), so all groups are aggregated in a single group-by
+    operation instead of filtering and aggregating the DataFrame once per group.
+
+    Parameters:
+        df: DataFrame containing the data of interest.
+        categories: List of the names of the landtype groups of interest (e.g., ['forest', 'shrub', 'pasture']).
+        category_label: String specifying the label for the landtype column in the DataFrame (most likely this will just be 'landtype').
+        value_label: String specifying the label for the column containing the value of interest.
+        landtype_groups: Dictionary where the keys are landtype group names and the values are all the landtypes that belong to each group.
+        mean_or_sum_if_more_than_one_row_in_same_landtype_group: String that indicates the operation that should be performed on each group.
+        key_columns: Columns on which the aggregation (group-by) operation should be performed.
+
+    Returns:
+        DataFrame with aggregated rows for all groups, ordered by group as in landtype_groups, with the category_label column set to the name of 
+        the group and the value_label column modified to reflect a mean, sum, area-weighted mean, or area-weighted sum.
+    """
+    # Map each landtype to its group and keep only the rows that correspond to one of the landtypes in the groups of interest.
+    groups = df[category_label].map(get_landtype_group_lookup(landtype_groups)).rename(category_label)
+    in_groups = groups.isin(categories)
+    groups = groups[in_groups]
+    columns = key_columns + [col for col in df.columns if col not in key_columns]
+    landtypes = df.loc[in_groups, category_label]
+    df = df[in_groups].drop(columns=category_label)
+
+    if mean_or_sum_if_more_than_one_row_in_same_landtype_group in ['area_weighted_mean', 'area_weighted_sum']:
+        df = df.assign(**{value_label: df['area']*df[value_label]})
+    df = df.groupby([groups] + key_columns, observed=True).sum()
+
+    if mean_or_sum_if_more_than_one_row_in_same_landtype_group == 'mean':
+        # The sum of each group is divided by the number of landtypes of the group that appear in the DataFrame.
+        num_landtypes_in_df = landtypes.groupby(groups, observed=True).nunique()
+        df[value_label] /= num_landtypes_in_df.reindex(df.index.get_level_values(category_label)).to_numpy()
+    elif mean_or_sum_if_more_than_one_row_in_same_landtype_group == 'area_weighted_mean':
+        df[value_label] = df[value_label].div(df['area'], axis=0)
+    df = df.reset_index()
+    df[category_label] = df[category_label].astype(str)
+    return df[columns]
+
 def produce_dataframe_for_landtype_group(df, category, category_label, value_label, 
                 landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns):
     """ 
     Aggregates the rows of a given Pandas DataFrame that match the specified landtype_group (e.g., crop, forest, pasture, shrub, grass).
     Performs one of four user-specified operations on the rows in the group: mean, sum, area-weighted mean, or area-weighted sum.
+    To aggregate several landtype groups, use produce_dataframe_for_landtype_groups() once for all of them instead of calling this function for each.
 
     Parameters:
         df: DataFrame containing the data of interest.
@@ -147,26 +217,5 @@ def produce_dataframe_for_landtype_group(df, category, category_label, value_lab
     Returns:
         DataFrame with aggregated rows and the value_label column modified to reflect a mean, sum, area-weighted mean, or area-weighted sum.
     """
-    # Get all landtypes for the group and filter the DataFrame to keep only the rows that correspond to one of the landtypes in the group.
-    landtypes = landtype_groups[category]
-    df = df[df[category_label].isin(landtypes)]
-
-    if mean_or_sum_if_more_than_one_row_in_same_landtype_group == 'mean':
-        landtypes_in_df = [x for x in landtypes if x in df[category_label].unique()]
-        num_landtypes_in_df = len(landtypes_in_df)
-        df = df.groupby(key_columns).sum()
-        df.loc[:, value_label] /= num_landtypes_in_df
-        df = df.reset_index()
-    elif mean_or_sum_if_more_than_one_row_in_same_landtype_group == 'sum':
-        df = df.groupby(key_columns).sum().reset_index()
-    elif mean_or_sum_if_more_than_one_row_in_same_landtype_group == 'area_weighted_mean':
-        df.loc[:, value_label] = df['area']*df[value_label]
-        df = df.groupby(key_columns).sum()
-        total_area = df['area']
-        df.loc[:, value_label] = df.loc[:, value_label].div(total_area, axis=0)
-        df = df.reset_index()
-    elif mean_or_sum_if_more_than_one_row_in_same_landtype_group == 'area_weighted_sum':
-        df[:, value_label] = df['area']*df[value_label]
-        df = df.groupby(key_columns).sum().reset_index()
-    df[category_label] = category
-    return df
\ No newline at end of file
+    return produce_dataframe_for_landtype_groups(df, [category], category_label, value_label, 
+                landtype_groups, mean_or_sum_if_more_than_one_row_in_same_landtype_group, key_columns)
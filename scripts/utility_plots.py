@@ -1,4 +1,6 @@
 from matplotlib import pyplot as plt
+from matplotlib import ticker
+import numpy as np
 
 # Default values for different plotting options.
 width_default = 10  # inches.
@@ -40,6 +42,9 @@ linestyle_tuples_default = [
 """ Markers (https://matplotlib.org/stable/gallery/lines_bars_and_markers/marker_reference.html). """
 markers_default = ['o', 'v', '^', '<', '>', '8', 's', 'p', '*', 'h', 'H', 'D', 'd', 'P', 'X', '1', '2', '3', '4', '+', 'x', '|']
 
+""" Map templates of this process (see get_map_template()), keyed by their layout, so that each layout is only built once per process. """
+map_templates = {}
+
 def setup_plot_params(options):
     """
     Sets up matplotlib parameters before creating a plot.
@@ -168,4 +173,88 @@ def set_figure_options(fig, ax, options):
     height = options.get('height', height_default)
     fig.set_size_inches(width, height)
     name = options['name']
-    save_figure(name, fig, options)
\ No newline at end of file
+    save_figure(name, fig, options)
+
+def add_colorbar_to_map_template(template, cbar_x_offset):
+    """
+    Adds a colorbar for the data artist of a map template to the right of the map axes or, if the template already has one, updates it to the current 
+    data and color limits of the data artist. The colorbar is only added once the data artist has been drawn, since the position of the map axes 
+    depends on the extent of the map.
+
+    Parameters:
+        template: Dictionary for the map template from get_map_template().
+        cbar_x_offset: Horizontal offset between the map axes and the colorbar.
+
+    Returns:
+        Colorbar of the map template.
+    """
+    if template['cbar'] is None:
+        fig, ax = template['fig'], template['ax']
+        cbar_ax = fig.add_axes([ax.get_position().x1+cbar_x_offset, ax.get_position().y0, 0.02, ax.get_position().height])
+        template['cbar'] = fig.colorbar(template['data_artist'], cax=cbar_ax)
+    else:
+        template['cbar'].update_normal(template['data_artist'])
+    return template['cbar']
+
+def clear_map_template(template):
+    """
+    Removes the artists that belong to a single map (e.g., statistics text and stippling) from a map template, so that the template can be reused 
+    for the next map. The data artist and colorbar of the template are kept, since the next map only updates them.
+
+    Parameters:
+        template: Dictionary for the map template from get_map_template().
+
+    Returns:
+        N/A.
+    """
+    for artist in template['map_artists']:
+        artist.remove()
+    template['map_artists'] = []
+    template['ax'].set_title('')
+
+def get_default_color_limits(data):
+    """
+    Calculates the default color limits that xarray uses when plotting data without specified limits: the minimum and maximum of the finite values,
+    made symmetric about zero if the data has both negative and positive values, so that a diverging colormap is centered at zero.
+
+    Parameters:
+        data: NumPy array (or array-like object) of the data to plot.
+
+    Returns:
+        Tuple of the lower and upper color limits.
+    """
+    finite_data = np.asarray(data)[np.isfinite(data)]
+    if finite_data.size == 0:
+        finite_data = np.array([0.0])
+    vmin, vmax = finite_data.min(), finite_data.max()
+    if vmin < 0 < vmax:
+        vlim = max(abs(vmin), abs(vmax))
+        vmin, vmax = -vlim, vlim
+    if vmin == vmax:
+        vmin, vmax = ticker.LinearLocator(2).tick_values(vmin, vmax)
+    return vmin, vmax
+
+def get_map_template(projection, width, height, key=None):
+    """
+    Gets a map template for batch plotting of maps with the same layout: a figure with map axes that have the projection and coastlines. The template
+    is built only once per process for each layout. Plotting functions set the data artist (e.g., a QuadMesh or PolyCollection) and colorbar (see 
+    add_colorbar_to_map_template()) of the template for the first map and, for each subsequent map, only update the data of the artist (set_array()), 
+    its color limits, the title, and the artists that belong to that map alone (kept in 'map_artists' and removed by clear_map_template()).
+
+    Parameters:
+        projection: Cartopy projection class (e.g., cartopy.crs.Robinson) of the map axes.
+        width: Width of the figure in inches.
+        height: Height of the figure in inches.
+        key: Additional hashable key for maps that cannot share a template (e.g., maps on different grids or with different colorbar options).
+
+    Returns:
+        Dictionary containing the figure ('fig'), map axes ('ax'), data artist ('data_artist'), colorbar ('cbar'), and list of artists that belong to 
+        the current map ('map_artists'). The data artist and colorbar are None until they are set for the first map.
+    """
+    template_key = (projection, width, height, key)
+    if template_key not in map_templates:
+        fig = plt.figure(figsize=(width, height))
+        ax = fig.add_axes([0.1, 0.1, 0.8, 0.8], projection=projection())
+        ax.coastlines(lw=0.6)
+        map_templates[template_key] = {'fig': fig, 'ax': ax, 'data_artist': None, 'cbar': None, 'map_artists': []}
+    return map_templates[template_key]
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+def calculate_mann_whitney_u_p_values(data_set_1, data_set_2):
+    """
+    Performs the Mann-Whitney U test along the last axis for all other positions at once, choosing the method for each position as SciPy would
+    if the position were tested alone: the exact distribution for small samples without ties, and the normal approximation otherwise.
+
+    Parameters:
+        data_set_1: NumPy array for the first data set, without NaN values, with the samples along the last axis.
+        data_set_2: NumPy array for the second data set, without NaN values, with the samples along the last axis.
+
+    Returns:
+        NumPy array of the p-values, with the last axis removed.
+    """
+    # SciPy chooses a single method for the whole array, so any position with ties would otherwise force the normal approximation on all positions.
+    combined_data = np.sort(np.concatenate([data_set_1, data_set_2], axis=-1), axis=-1)
+    has_ties = (np.diff(combined_data, axis=-1) == 0).any(axis=-1)
+    p_values = np.full(has_ties.shape, np.nan)
+    for positions, method in [(~has_ties, 'auto'), (has_ties, 'asymptotic')]:
+        if positions.any():
+            p_values[positions] = stats.mannwhitneyu(data_set_1[positions], data_set_2[positions], axis=-1, method=method).pvalue
+    return p_values
+
+def calculate_p_values_along_axis(data_set_1, data_set_2, axis=-1, test='welch_ttest'):
+    """
+    Compares two (presumed) independent data sets with a statistical test along the given axis (e.g., over the ensemble members) and returns the
+    p-values for all other positions at once (e.g., for every grid cell, region, or year), instead of calling the test once per position.
+
+    Parameters:
+        data_set_1: NumPy array (or array-like object) for the first data set.
+        data_set_2: NumPy array (or array-like object) for the second data set. Its shape must match that of the first data set, except along the axis.
+        axis: Axis over which the samples of each data set are taken.
+        test: Statistical test to perform: 'welch_ttest' (t-test for the means without assuming equal variances), 'student_ttest' (t-test for the
+              means assuming equal variances), or 'mann_whitney_u' (nonparametric test that does not assume normally distributed samples).
+
+    Returns:
+        NumPy array of the p-values, with the axis removed. Positions with NaN values in either data set have a p-value of NaN.
+    """
+    if test == 'welch_ttest':
+        calculate_p_values = lambda set_1, set_2: stats.ttest_ind(set_1, set_2, axis=-1, equal_var=False).pvalue
+    elif test == 'student_ttest':
+        calculate_p_values = lambda set_1, set_2: stats.ttest_ind(set_1, set_2, axis=-1, equal_var=True).pvalue
+    elif test == 'mann_whitney_u':
+        calculate_p_values = calculate_mann_whitney_u_p_values
+    else:
+        raise ValueError(f"Unknown statistical test {test}; the possible tests are 'welch_ttest', 'student_ttest', and 'mann_whitney_u'.")
+
+    # Move the sample axis to the end. SciPy falls back to testing one position at a time if any value is NaN (e.g., ocean grid cells in ELM data), 
+    # so only the positions without NaN values are passed to the test, all at once, and the others are given a p-value of NaN.
+    data_set_1 = np.moveaxis(np.asarray(data_set_1, dtype=np.float64), axis, -1)
+    data_set_2 = np.moveaxis(np.asarray(data_set_2, dtype=np.float64), axis, -1)
+    is_valid = ~(np.isnan(data_set_1).any(axis=-1) | np.isnan(data_set_2).any(axis=-1))
+    p_values = np.full(is_valid.shape, np.nan)
+    if is_valid.any():
+        p_values[is_valid] = calculate_p_values(data_set_1[is_valid], data_set_2[is_valid])
+    return p_values
+
+def calculate_p_values_for_dataframe_rows(df, columns_set_1, columns_set_2, test='welch_ttest'):
+    """
+    Compares two sets of columns in a Pandas DataFrame (e.g., the ensemble members of two scenarios) with a statistical test in every row at once.
+    This replaces calling a test on each row with df.apply(..., axis=1).
+
+    Parameters:
+        df: DataFrame containing the columns for both data sets.
+        columns_set_1: List of columns in the DataFrame for the first data set.
+        columns_set_2: List of columns in the DataFrame for the second data set.
+        test: Statistical test to perform (see calculate_p_values_along_axis()).
+
+    Returns:
+        Pandas Series of the p-values with the same index as the DataFrame.
+    """
+    p_values = calculate_p_values_along_axis(df[columns_set_1].to_numpy(), df[columns_set_2].to_numpy(), axis=1, test=test)
+    return pd.Series(p_values, index=df.index)
@@ -1,6 +1,9 @@
 import uxarray as ux
 import xarray as xr
 
+""" Unstructured grids that have already been opened in this process, keyed by the name of the grid file (see open_grid()). """
+grids = {}
+
 def calculate_mean_and_std_of_da_list(da_list, calculate_std=False):
     """
     Calculates the mean of a list of xarray DataArrays and optionally also the standard deviation of this list.
@@ -74,4 +77,20 @@ def convert_xarray_to_uxarray(data, grid, variable=None, fillna=1):
     if fillna:
         return ux.UxDataset.from_xarray(ds, grid).fillna(fillna)
     else:
-        return ux.UxDataset.from_xarray(ds, grid)
\ No newline at end of file
+        return ux.UxDataset.from_xarray(ds, grid)
+
+def open_grid(grid_file):
+    """
+    Opens the unstructured grid in a grid file (e.g., the ne30pg2 grid of EAM) as an uxarray Grid, reusing the Grid if it has already been opened 
+    in this process. Parsing the grid and building its polygons for plotting (which uxarray caches on the Grid) is then done only once per worker 
+    process, instead of once for every variable that the process plots.
+
+    Parameters:
+        grid_file: Complete path and name of the grid file.
+
+    Returns:
+        uxarray Grid of the grid file.
+    """
+    if grid_file not in grids:
+        grids[grid_file] = ux.open_grid(grid_file)
+    return grids[grid_file]